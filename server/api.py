@@ -2,8 +2,9 @@
 Authors: Andrew Golightly, Paul Fischer
 """
 import flask
-from flask import request, jsonify
-from server import config, d3_conversion_utils, d3_conversion
+from flask import request
+from server import api_encoding, config, d3_cache, d3_conversion_utils, d3_conversion, d3_enrichment, d3_http, \
+    d3_refresher, d3_singleflight, d3_timeseries, d3_workers
 from flask_cors import CORS
 import logging, sys
 
@@ -15,6 +16,12 @@ cors = CORS(app)
 
 logging.info(config.variables)
 
+# Formats accepted by the traffic_format parameter; see d3_conversion.traffic_columns.
+traffic_formats = ('points', 'columns')
+
+# Keeps the enrichment metadata (interface maps, TSDS table, RDAP bootstrap) up to date off the request path.
+d3_refresher.start()
+
 @app.route('/', methods=['GET'])
 def home():
     """
@@ -32,22 +39,49 @@ def test():
     Test endpoint - used to see if API server is running
     :return:  JSON, content isn't super important. It's just examined to see if it exists.
     """
-    response = {'success': 'api server running'}
-    response = jsonify(response)
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    return response
+    return api_encoding.respond({'success': 'api server running'})
+
+
+@app.route('/api/v1/stats', methods=['GET'])
+def stats():
+    """
+    Stats endpoint - used to monitor the state of the server.
+    :return: JSON with the state of the shared enrichment worker pool (queue depth, active workers, per provider
+    counts), the outbound HTTP connection pools (new vs. reused connections), the number of coalesced lookups, the
+    enrichment cache (hits, misses, evictions), the traffic time series cache (fresh/stale hits, refreshes), and the
+    background refresh jobs.
+    """
+    response = {'workers': d3_workers.stats(), 'http': d3_http.stats(), 'singleflight': d3_singleflight.stats(),
+                'cache': d3_cache.stats(), 'timeseries': d3_timeseries.stats(), 'refresher': d3_refresher.stats()}
+    return api_encoding.respond(response)
 
 
 @app.route('/api/v1/resources/traceroutes', methods=['GET'])
 def traceroutes():
     """
     Handles running traceroutes.
-    :return: JSON string formatted for d3 with all additional information added.
+    Optional enrich parameter: comma separated names of the enrichment providers to run (see d3_enrichment), i.e.
+    enrich=geo,rdap,stardust_interfaces to leave out the traffic time series, which can then be loaded per hop from
+    /api/v1/resources/hops/<ip>/traffic. All providers are run by default; enrich= runs none.
+    Optional traffic_format parameter: points (default) or columns (see d3_conversion.traffic_columns).
+    :return: JSON string formatted for d3 with all additional information added. MessagePack instead if the Accept
+    header asks for application/msgpack (see api_encoding).
     """
 
     # Check for destination not being empty happens client side
     dest = request.args['dest']
 
+    enrich = None
+    if 'enrich' in request.args:
+        enrich = [name for name in request.args['enrich'].split(',') if name]
+        unknown = set(enrich) - set(d3_enrichment.provider_names())
+        if unknown:
+            return api_encoding.respond({'error': f'Unknown enrichment providers: {", ".join(sorted(unknown))}'}, 400)
+
+    traffic_format = request.args.get('traffic_format', 'points')
+    if traffic_format not in traffic_formats:
+        return api_encoding.respond({'error': f'Unknown traffic format: {traffic_format}'}, 400)
+
     # Checks for source for remote traceroute.
     source = None
     if "source" in request.args:
@@ -69,22 +103,42 @@ def traceroutes():
         # Check the source - if not found, return an error that works for the traceroute table.
         if d3_conversion_utils.check_pscheduler(source):
             print(f'{source} accepted as pScheduler source')
-            response = d3_conversion.pscheduler_to_d3(source, dest, num_runs)
+            response = d3_conversion.pscheduler_to_d3(source, dest, num_runs, enrich)
         else:
             response = {'error': 'pScheduler not found'}
     # Run a system traceroute
     else:
-        response = d3_conversion.system_to_d3(dest, num_runs)
+        response = d3_conversion.system_to_d3(dest, num_runs, enrich)
         # response = d3_conversion.system_to_d3_threaded(dest, num_runs)
 
-    print(response)
+    if traffic_format == 'columns' and response:
+        d3_conversion.columnar_traffic(response)
+
+    # Serialised (and compressed, if the client accepts it) by api_encoding.
+    return api_encoding.respond(response)
+
+
+@app.route('/api/v1/resources/hops/<ip>/traffic', methods=['GET'])
+def hop_traffic(ip):
+    """
+    Gets the traffic information (TSDS/Stardust) for a single hop, so it doesn't have to be sent with every traceroute.
+    Optional traffic_format parameter: points (default) or columns (see d3_conversion.traffic_columns).
+    :param ip: IP address of the hop.
+    :return: JSON with the hop's IP and, if available, its traffic_info and interface fields (resource, speed,
+    max_bandwidth).
+    """
+    if not d3_conversion_utils.ip_validation_regex.match(ip):
+        return api_encoding.respond({'error': 'Invalid IP address'}, 400)
+
+    traffic_format = request.args.get('traffic_format', 'points')
+    if traffic_format not in traffic_formats:
+        return api_encoding.respond({'error': f'Unknown traffic format: {traffic_format}'}, 400)
 
-    # Use jsonify to convert python dictionary to json.
-    response = jsonify(response)
+    packet = d3_conversion.hop_traffic(ip)
+    if traffic_format == 'columns' and 'traffic_info' in packet:
+        packet['traffic_info'] = d3_conversion.traffic_columns(packet['traffic_info'])
 
-    # Something required for hosting tool and API on same box - should be restricted more, but for development it works.
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    return response
+    return api_encoding.respond(packet)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,133 @@
+"""
+Response encoding for the API. Responses are serialised as JSON with orjson (falling back to the standard library
+encoder if it isn't installed), or as MessagePack if the client's Accept header prefers it. They're then compressed with
+brotli or gzip, depending on the client's Accept-Encoding header. Responses smaller than response_compress_min_size (see
+the config file) aren't compressed.
+"""
+import gzip
+import json
+
+import flask
+from flask import request
+
+from server import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Content encodings we can produce, most preferred first.
+content_encodings = ['br', 'gzip', 'identity'] if brotli is not None else ['gzip', 'identity']
+# Media types we can produce, most preferred first; JSON is used if the client doesn't ask for anything else.
+media_types = ['application/json', 'application/msgpack', 'application/x-msgpack'] if msgpack is not None \
+    else ['application/json']
+
+
+def encode_json(data):
+    """
+    :param data: JSON serializable data. Dictionary keys don't have to be strings (i.e. Stardust timestamps); they're
+    converted the same way the standard library encoder converts them.
+    :return: JSON (bytes).
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def _key_to_str(key):
+    """
+    :return: Dictionary key as a string, converted the same way the JSON encoders convert it.
+    """
+    if isinstance(key, str):
+        return key
+    if key is None or isinstance(key, (bool, float)):
+        return json.dumps(key)
+    return str(key)
+
+
+def _str_keys(data, converted):
+    """
+    :param data: JSON serializable data.
+    :param converted: id(container) => converted container, so containers shared between packets (i.e. cached traffic
+    info) are only converted once.
+    :return: Copy of data with every dictionary key converted to a string. data isn't modified.
+    """
+    if isinstance(data, dict):
+        if id(data) not in converted:
+            converted[id(data)] = {_key_to_str(key): _str_keys(value, converted) for key, value in data.items()}
+        return converted[id(data)]
+    if isinstance(data, (list, tuple)):
+        if id(data) not in converted:
+            converted[id(data)] = [_str_keys(value, converted) for value in data]
+        return converted[id(data)]
+    return data
+
+
+def encode_msgpack(data):
+    """
+    Same schema as encode_json; dictionary keys are converted to strings the same way (i.e. Stardust timestamps), so
+    both formats decode to the same structure.
+    :param data: JSON serializable data.
+    :return: MessagePack (bytes).
+    """
+    return msgpack.packb(_str_keys(data, {}))
+
+
+def compress(body, encoding):
+    """
+    :param body: Bytes to compress.
+    :param encoding: Content encoding; br, gzip, or identity.
+    :return: Compressed bytes.
+    """
+    if encoding == 'br':
+        # Quality 4 is about as fast as gzip and still smaller; the higher qualities are too slow to run per request.
+        return brotli.compress(body, quality=4)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+
+def negotiate_media_type():
+    """
+    Must be called while handling a request.
+    :return: Media type to use for the response, based on the Accept header.
+    """
+    return request.accept_mimetypes.best_match(media_types, default='application/json')
+
+
+def negotiate_encoding():
+    """
+    Must be called while handling a request.
+    :return: Content encoding to use for the response, based on the Accept-Encoding header.
+    """
+    return request.accept_encodings.best_match(content_encodings, default='identity')
+
+
+def respond(data, status=200):
+    """
+    Builds the response for an endpoint. Must be called while handling a request.
+    :param data: JSON serializable data.
+    :param status: HTTP status code.
+    :return: Flask response.
+    """
+    media_type = negotiate_media_type()
+    body = encode_json(data) if media_type == 'application/json' else encode_msgpack(data)
+    encoding = negotiate_encoding() if len(body) >= config.variables['response_compress_min_size'] else 'identity'
+    response = flask.Response(compress(body, encoding), status=status, mimetype=media_type)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    # Something required for hosting tool and API on same box - should be restricted more, but for development it works.
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
@@ -0,0 +1,226 @@
+"""
+Benchmarks for the in-memory data structures used by the enrichment modules, and for the API responses. None of
+these touch the network.
+Usage:
+    python -m server.benchmarks [<benchmark name> ...]
+Runs every benchmark if no names are given.
+"""
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import flask
+
+from server import api_encoding, d3_conversion, d3_conversion_utils, d3_stardust, d3_tsds
+
+
+def _measure(fn):
+    """
+    :return: Tuple of (result of fn(), bytes still allocated by fn once it returns).
+    """
+    tracemalloc.start()
+    result = fn()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def tsds_index(count=1000000, lookups=100000):
+    """
+    Memory use and lookup speed of the TSDS index (d3_tsds.tsds_index_load / tsds_index_get) for a resources table of
+    count IPs, compared to keeping the same data in a dict keyed by IP string.
+    """
+    ips = [d3_conversion_utils.int_to_ip(i) for i in random.sample(range(1 << 24, 0xDF000000), count)]
+    fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        con = sqlite3.connect(db_path)
+        con.execute('CREATE TABLE resources (ip text primary key not null, tsds_enabled integer, last_modified datetime '
+                    'default current_timestamp)')
+        con.executemany('INSERT INTO resources (ip, tsds_enabled) VALUES (?, ?)',
+                        ((ip, random.random() < 0.01) for ip in ips))
+        con.commit()
+        con.close()
+
+        start = time.perf_counter()
+        d3_tsds.tsds_index_load(db_path)
+        print(f'Loaded {count} IPs in {time.perf_counter() - start:.2f} s')
+        _, index_size = _measure(lambda: d3_tsds.tsds_index_load(db_path))
+        print(f'  packed index: {index_size / 1e6:.1f} MB')
+        rows, dict_size = _measure(lambda: {ip: (enabled, modified) for ip, enabled, modified in
+                                            sqlite3.connect(db_path).execute('SELECT * FROM resources')})
+        print(f'  dict of IP => row: {dict_size / 1e6:.1f} MB')
+
+        # Half of the lookups are for IPs in the table.
+        queries = random.sample(ips, lookups // 2) + \
+            [d3_conversion_utils.int_to_ip(i) for i in random.sample(range(0xE0000000, 0xEFFFFFFF), lookups // 2)]
+        start = time.perf_counter()
+        found = d3_tsds.tsds_index_get(queries)
+        index_time = time.perf_counter() - start
+        start = time.perf_counter()
+        dict_found = [ip for ip in queries if ip in rows]
+        dict_time = time.perf_counter() - start
+        assert len(found) == len(dict_found)
+        print(f'{lookups} lookups:')
+        print(f'  packed index: {index_time * 1e9 / lookups:.0f} ns per IP')
+        print(f'  dict of IP => row: {dict_time * 1e9 / lookups:.0f} ns per IP')
+    finally:
+        os.remove(db_path)
+        # Put the real index back.
+        d3_tsds.tsds_index_load()
+
+
+def sd_interface_index(count=25000, lookups=100000):
+    """
+    Startup time, memory use, and lookup speed of the compiled Stardust interface index (d3_stardust.lookup_interface)
+    for count interfaces, compared to parsing the interface file into a dict.
+    """
+    ips = [d3_conversion_utils.int_to_ip(i) for i in random.sample(range(1 << 24, 0xDF000000), count)]
+    sd_map = {ip: {'resource': f'rtr{i % 500}-cr6::to_site_{i}', 'speed': random.choice([10, 100, 400]) * 1000000000}
+              for i, ip in enumerate(ips)}
+    tmp_dir = tempfile.mkdtemp()
+    file_path = os.path.join(tmp_dir, 'sd_interfaces.json')
+    index_path = os.path.join(tmp_dir, 'sd_interfaces.bin')
+    try:
+        with open(file_path, 'w') as f:
+            json.dump(sd_map, f)
+        d3_stardust.compile_interface_index(sd_map, index_path)
+        print(f'{count} interfaces; interface file {os.path.getsize(file_path) / 1e6:.1f} MB, index file '
+              f'{os.path.getsize(index_path) / 1e6:.1f} MB')
+
+        def load_dict():
+            with open(file_path) as f:
+                return json.load(f)
+
+        start = time.perf_counter()
+        load_dict()
+        dict_time = time.perf_counter() - start
+        start = time.perf_counter()
+        d3_stardust.load_interface_index(index_path)
+        index_time = time.perf_counter() - start
+        print('Startup:')
+        print(f'  dict (json.load): {dict_time * 1000:.1f} ms')
+        print(f'  index (mmap): {index_time * 1000:.3f} ms')
+
+        loaded, dict_size = _measure(load_dict)
+        index, index_size = _measure(lambda: d3_stardust.load_interface_index(index_path))
+        print('Private memory per process (the index pages are shared between processes through the page cache):')
+        print(f'  dict: {dict_size / 1e6:.1f} MB')
+        print(f'  index: {index_size / 1e3:.1f} KB')
+
+        d3_stardust.reload_interface_map(file_path, index_path)
+        queries = random.choices(ips, k=lookups // 2) + \
+            [d3_conversion_utils.int_to_ip(i) for i in random.sample(range(0xE0000000, 0xEFFFFFFF), lookups // 2)]
+        start = time.perf_counter()
+        for ip in queries:
+            loaded.get(ip)
+        dict_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for ip in queries:
+            d3_stardust.lookup_interface(ip)
+        index_time = time.perf_counter() - start
+        print(f'{lookups} lookups:')
+        print(f'  dict: {dict_time * 1e9 / lookups:.0f} ns per IP')
+        print(f'  index: {index_time * 1e9 / lookups:.0f} ns per IP')
+    finally:
+        shutil.rmtree(tmp_dir)
+        # Put the real index back.
+        d3_stardust.reload_interface_map()
+
+
+def _traceroute_response(num_runs, hops, points):
+    """
+    :return: Synthetic traceroute response with num_runs runs through the same hops, each hop with points points of
+    traffic info. The packets for a hop share a series, the same as responses built from the time series cache.
+    """
+    metrics = ['traffic_in', 'traffic_out', 'unicast_packets_in', 'unicast_packets_out', 'errors_in', 'errors_out']
+    now = int(time.time()) // 60 * 60
+    series = []
+    for _ in range(hops):
+        series.append({str(ts): {'ts': ts, **{metric: random.random() * 1e9 for metric in metrics}}
+                       for ts in range(now - 60 * points, now, 60)})
+    return {'traceroutes': [{'packets': [{'ip': d3_conversion_utils.int_to_ip(i), 'ttl': i + 1, 'rtt': 1.0,
+                                          'traffic_info': series[i]} for i in range(hops)]}
+                            for _ in range(num_runs)]}
+
+
+def traffic_format(num_runs=10, hops=20, points=15, repeat=20):
+    """
+    Payload size and serialisation time (json.dumps) of a traceroute response with traffic info for every hop, in the
+    points format (as returned by the providers) and in the columnar format (d3_conversion.columnar_traffic; the
+    conversion is included in the time).
+    """
+    print(f'{num_runs} runs, {hops} hops with traffic info, {points} points per series:')
+    for name, convert in (('points', lambda d3_json: d3_json), ('columns', d3_conversion.columnar_traffic)):
+        responses = [_traceroute_response(num_runs, hops, points) for _ in range(repeat)]
+        start = time.perf_counter()
+        for d3_json in responses:
+            payload = json.dumps(convert(d3_json))
+        elapsed = time.perf_counter() - start
+        print(f'  {name}: {len(payload) / 1e3:.1f} KB, {elapsed * 1000 / repeat:.2f} ms per response')
+
+
+def response_encoding(num_runs=10, hops=20, points=15, repeat=20):
+    """
+    Encode time and bytes on the wire for a traceroute response with traffic info for every hop; the previous response
+    path (print the response, then jsonify - pretty printed, since the API runs in debug mode) compared to
+    api_encoding (orjson, plus gzip or brotli, or MessagePack), and the time to parse the JSON and MessagePack
+    responses.
+    """
+    d3_json = _traceroute_response(num_runs, hops, points)
+    app = flask.Flask(__name__)
+    app.config['DEBUG'] = True
+
+    def print_and_jsonify():
+        with contextlib.redirect_stdout(io.StringIO()):
+            print(d3_json)
+        with app.app_context():
+            return flask.jsonify(d3_json).get_data()
+
+    paths = [('print + jsonify', print_and_jsonify)]
+    for encoding in api_encoding.content_encodings[::-1]:
+        paths.append((f'api_encoding ({encoding})',
+                      lambda encoding=encoding: api_encoding.compress(api_encoding.encode_json(d3_json), encoding)))
+    if api_encoding.msgpack is not None:
+        paths.append(('api_encoding (msgpack)', lambda: api_encoding.encode_msgpack(d3_json)))
+
+    print(f'{num_runs} runs, {hops} hops with traffic info, {points} points per series:')
+    for name, encode in paths:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            body = encode()
+        elapsed = time.perf_counter() - start
+        print(f'  {name}: {len(body) / 1e3:.1f} KB, {elapsed * 1000 / repeat:.2f} ms per response')
+
+    # Parsing, i.e. by clients polling the API from Python.
+    parsers = [('json.loads', json.loads, api_encoding.encode_json(d3_json))]
+    if api_encoding.msgpack is not None:
+        parsers.append(('msgpack.unpackb', api_encoding.msgpack.unpackb, api_encoding.encode_msgpack(d3_json)))
+    print('Parsing:')
+    for name, parse, body in parsers:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            parse(body)
+        elapsed = time.perf_counter() - start
+        print(f'  {name}: {elapsed * 1000 / repeat:.2f} ms per response')
+
+
+benchmarks = {
+    'tsds_index': tsds_index,
+    'sd_interface_index': sd_interface_index,
+    'traffic_format': traffic_format,
+    'response_encoding': response_encoding
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or benchmarks:
+        print(f'--- {name} ---')
+        benchmarks[name]()
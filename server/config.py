@@ -11,10 +11,53 @@ variables = {
     },
     'interface_file': 'interfaces.json',
     'sd_interface_file': 'sd_interfaces.json',
+    'sd_interface_index_file': 'sd_interfaces.bin',
+    'sd_traffic_mode': 'hits',
     'tsds_db_file': 'tsds_ip.db',
     'interface_refresh_interval': 86400,
+    'sd_interface_check_interval': 60,
+    'sd_interface_incremental_interval': 3600,
+    'interface_link_prefix': 31,
     'tsds_refresh_interval': 1209600,
-    'tr_start_port': 33434
+    'tsds_batch_size': 25,
+    'tsds_refresh_check_interval': 3600,
+    'tsds_refresh_limit': 1000,
+    'tsds_index_check_interval': 300,
+    'timeseries_window': 900,
+    'timeseries_step': 60,
+    'timeseries_cache_size': 5000,
+    'tr_start_port': 33434,
+    'worker_pool_size': 32,
+    'worker_wait_timeout': 20,
+    'http_pool_connections': 20,
+    'http_pool_maxsize': 16,
+    'singleflight_timeout': 30,
+    'geo_backend': 'ip-api',
+    'geo_db_file': 'geo_ip.bin',
+    'rdap_cache_ttl': 86400,
+    'rdap_cache_size': 10000,
+    'rdap_bootstrap_file': 'rdap_bootstrap.json',
+    'rdap_bootstrap_refresh_interval': 604800,
+    'rdap_bootstrap_check_interval': 3600,
+    'refresh_jitter': 0.1,
+    'refresh_startup_jitter': 10,
+    'response_compress_min_size': 1024,
+    'cache_db_file': 'enrichment_cache.db',
+    'cache_memory_size': 10000,
+    'cache_ttl': {
+        'default': 86400,
+        'geo': 604800,
+        'whois': 604800,
+        'rdap': 86400,
+        'asn': 604800
+    },
+    'provider_concurrency': {
+        'default': 4,
+        'tsds': 8,
+        'stardust': 8,
+        'geo': 8,
+        'rdap': 8
+    }
 }
 
 # Need the server/... when running as part of flask; not needed when running directly.
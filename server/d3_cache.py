@@ -0,0 +1,214 @@
+"""
+Tiered cache for enrichment results (geoIP, RDAP, ASN). Each provider has a size capped, in-memory LRU tier in front
+of a persistent SQLite tier. The SQLite tier uses WAL mode, so it can be shared by every process on the host (i.e. every
+WSGI worker); a restarted or new worker starts with whatever the other workers have already looked up.
+Entries expire after a per provider TTL (cache_ttl in the config file). Values must be JSON serializable.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from server import config
+
+# Used to protect the memory tier and the counters below.
+_lock = threading.Lock()
+# provider => OrderedDict of key => (value, expiry time), least recently used first.
+_memory = dict()
+# provider => {'hits': ..., 'disk_hits': ..., 'misses': ..., 'evictions': ...}
+_stats = dict()
+# Each thread gets its own SQLite connection.
+_local = threading.local()
+
+
+def _provider_stats(provider):
+    """
+    Must be called with _lock held.
+    """
+    if provider not in _stats:
+        _stats[provider] = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+    return _stats[provider]
+
+
+def ttl(provider):
+    """
+    :param provider: Provider name.
+    :return: Number of seconds before the provider's entries expire.
+    """
+    ttls = config.variables['cache_ttl']
+    return ttls.get(provider, ttls['default'])
+
+
+def _connection():
+    """
+    :return: SQLite connection for the calling thread, or None if the database can't be opened.
+    """
+    if not hasattr(_local, 'con'):
+        try:
+            con = sqlite3.connect(config.variables['cache_db_file'], timeout=10)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            con.execute('CREATE TABLE IF NOT EXISTS cache (provider text not null, key text not null, value text, '
+                        'expires real, primary key (provider, key))')
+            con.commit()
+            _local.con = con
+        except sqlite3.Error as e:
+            print(f'Unable to open the enrichment cache database: {e!r}')
+            _local.con = None
+    return _local.con
+
+
+def _memory_put(provider, key, value, expires):
+    """
+    Must be called with _lock held. Adds an entry to the memory tier, evicting the least recently used entries if the
+    provider is over its size cap.
+    """
+    entries = _memory.setdefault(provider, OrderedDict())
+    entries[key] = (value, expires)
+    entries.move_to_end(key)
+    while len(entries) > config.variables['cache_memory_size']:
+        entries.popitem(last=False)
+        _provider_stats(provider)['evictions'] += 1
+
+
+def get_many(provider, keys, persistent=True, count=True):
+    """
+    Looks up multiple keys; the memory tier is checked first, then the SQLite tier (in a single query) for anything
+    missing. Entries found in the SQLite tier are added to the memory tier.
+    :param provider: Provider name.
+    :param keys: Iterable of keys (strings).
+    :param persistent: If False, only the memory tier is checked.
+    :param count: If False, the lookups aren't counted in the stats, i.e. when the keys are candidates for a single
+    logical lookup; the caller should count the outcome with record instead.
+    :return: Dictionary of key => value for every key found.
+    """
+    now = time.time()
+    results = {}
+    missing = []
+    with _lock:
+        entries = _memory.get(provider, {})
+        stats = _provider_stats(provider)
+        for key in keys:
+            entry = entries.get(key)
+            if entry is not None and entry[1] > now:
+                entries.move_to_end(key)
+                results[key] = entry[0]
+                stats['hits'] += count
+            else:
+                if entry is not None:
+                    del entries[key]
+                missing.append(key)
+
+    found = {}
+    con = _connection() if persistent and missing else None
+    if con is not None:
+        try:
+            # SQLite limits the number of parameters per query, so large lookups are split.
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                rows = con.execute(f'SELECT key, value, expires FROM cache WHERE provider=? AND expires>? AND key IN '
+                                   f'({",".join("?" * len(chunk))})', [provider, now, *chunk]).fetchall()
+                for key, value, expires in rows:
+                    found[key] = (json.loads(value), expires)
+        except sqlite3.Error as e:
+            print(f'Unable to read from the enrichment cache database: {e!r}')
+
+    with _lock:
+        if count:
+            stats = _provider_stats(provider)
+            stats['disk_hits'] += len(found)
+            stats['misses'] += len(missing) - len(found)
+        for key, (value, expires) in found.items():
+            _memory_put(provider, key, value, expires)
+            results[key] = value
+    return results
+
+
+def record(provider, hits=0, disk_hits=0, misses=0):
+    """
+    Counts lookups in the stats; for lookups made with get_many(..., count=False).
+    :param provider: Provider name.
+    :param hits: Number of memory hits.
+    :param disk_hits: Number of SQLite hits.
+    :param misses: Number of misses.
+    """
+    with _lock:
+        stats = _provider_stats(provider)
+        stats['hits'] += hits
+        stats['disk_hits'] += disk_hits
+        stats['misses'] += misses
+
+
+def get(provider, key, persistent=True):
+    """
+    :param provider: Provider name.
+    :param key: Key (string).
+    :param persistent: If False, only the memory tier is checked.
+    :return: Cached value, or None if the key isn't cached.
+    """
+    return get_many(provider, [key], persistent).get(key)
+
+
+def put_many(provider, items, persistent=True):
+    """
+    Adds (or replaces) multiple entries in a single transaction.
+    :param provider: Provider name.
+    :param items: Dictionary of key => value.
+    :param persistent: If False, the entries are only added to the memory tier.
+    """
+    if not items:
+        return
+    expires = time.time() + ttl(provider)
+    with _lock:
+        for key, value in items.items():
+            _memory_put(provider, key, value, expires)
+
+    con = _connection() if persistent else None
+    if con is not None:
+        try:
+            with con:
+                con.executemany('INSERT OR REPLACE INTO cache (provider, key, value, expires) VALUES (?, ?, ?, ?)',
+                                [(provider, key, json.dumps(value), expires) for key, value in items.items()])
+        except sqlite3.Error as e:
+            print(f'Unable to write to the enrichment cache database: {e!r}')
+
+
+def put(provider, key, value, persistent=True):
+    """
+    Adds (or replaces) a single entry.
+    :param provider: Provider name.
+    :param key: Key (string).
+    :param value: JSON serializable value.
+    :param persistent: If False, the entry is only added to the memory tier.
+    """
+    put_many(provider, {key: value}, persistent)
+
+
+def remove_expired():
+    """
+    Removes expired entries from the SQLite tier.
+    """
+    con = _connection()
+    if con is not None:
+        try:
+            with con:
+                con.execute('DELETE FROM cache WHERE expires<=?', (time.time(),))
+        except sqlite3.Error as e:
+            print(f'Unable to clean up the enrichment cache database: {e!r}')
+
+
+def stats():
+    """
+    :return: Dictionary of provider => number of entries in the memory tier, memory hits, SQLite hits, misses, and
+    memory evictions.
+    """
+    with _lock:
+        return {
+            provider: {'memory_entries': len(_memory.get(provider, {})), **counts}
+            for provider, counts in _stats.items()
+        }
+
+
+# Clean up whenever we load this file
+remove_expired()
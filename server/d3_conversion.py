@@ -2,16 +2,16 @@
 Author: Andrew Golightly
 """
 import json
+import math
 import random
 import re
 import subprocess
 import threading
 import time
 
-import requests
 from icmplib import traceroute
 
-from server import d3_conversion_utils, d3_geo_ip, d3_rdap, d3_stardust, d3_tsds # d3_netbeam
+from server import d3_conversion_utils, d3_enrichment, d3_geo_ip, d3_http # d3_netbeam
 from server.config import variables as config
 
 # TODO: Add locks to everything, and variabalize the max and min limit values.
@@ -22,7 +22,7 @@ lock = threading.Lock()
 limiter = 0
 
 
-def pscheduler_to_d3(source, dest, num_runs=1):
+def pscheduler_to_d3(source, dest, num_runs=1, enrich=None):
     """
     Tries to run a pScheduler traceroute from source to destination.
     The source must also be running pScheduler, as must the server/machine running this code.
@@ -31,6 +31,8 @@ def pscheduler_to_d3(source, dest, num_runs=1):
     :param source: Source for traceroute
     :param dest: Destination for traceroute.
     :param num_runs: Number of times to run the traceroute.
+    :param enrich: Names of the enrichment providers to run (see add_additional_information). If None, all of them are
+    run.
     :return: JSON ingestible by the d3 visualisation if the traceroute is successful. None otherwise.
     """
 
@@ -116,7 +118,7 @@ def pscheduler_to_d3(source, dest, num_runs=1):
     limiter -= num_runs
     lock.release()
 
-    return add_additional_information(output)
+    return add_additional_information(output, enrich)
 
 
 def system_to_d3_icmplib_tw(dest, return_array, tr_id):
@@ -200,7 +202,7 @@ def esmond_to_d3(source=None, dest=None, ts_min=None, ts_max=None,
         return None
 
     # Get information from Esmond - this is all traceroutes run on this server stored in the Esmond DB.
-    traceroutes = requests.get(
+    traceroutes = d3_http.get(
         f"{esmond_server}/esmond/perfsonar/archive/?format=json&tool-name=pscheduler/traceroute", timeout=10).json()
 
     # Change ts values if not specified. Changes min to 0 and max to current epoch time + 180 days.
@@ -233,7 +235,7 @@ def esmond_to_d3(source=None, dest=None, ts_min=None, ts_max=None,
 
     # Access URLs relevant to source/dest
     for url in urls:
-        r = requests.get(f'{esmond_server}/{url[0]}/?format=json', timeout=10)
+        r = d3_http.get(f'{esmond_server}/{url[0]}/?format=json', timeout=10)
         try:
             for trace in r.json():
                 # Filter with ts info
@@ -460,12 +462,14 @@ def system_to_d3_threaded(dest, num_runs=1):
     return add_additional_information(output)
 
 
-def system_to_d3(dest, num_runs=1):
+def system_to_d3(dest, num_runs=1, enrich=None):
     """
     Runs a system traceroute to the desired destination. Single threaded, but uses multiple subprocesses so it may
     actually be multithreaded under the hood, so to speak.
     :param dest: Traceroute destination.
     :param num_runs: Number of runs.
+    :param enrich: Names of the enrichment providers to run (see add_additional_information). If None, all of them are
+    run.
     :return: JSON ingestible by the d3.
     """
 
@@ -570,7 +574,7 @@ def system_to_d3(dest, num_runs=1):
     limiter -= num_runs
     lock.release()
 
-    return add_additional_information(output)
+    return add_additional_information(output, enrich)
     # return output
 
 
@@ -589,16 +593,120 @@ def remove_unknowns(d3_json):
                 i += 1
 
 
-def add_additional_information(d3_json):
+def unique_hops(d3_json):
+    """
+    Collects the unique hop IPs across every traceroute in d3_json. Multiple runs to the same destination mostly
+    traverse the same hops, so enriching each IP once (instead of once per packet) saves num_runs - 1 lookups per hop
+    for every provider.
+    :param d3_json: JSON formatted for d3. Unknown hops should already be removed (see remove_unknowns).
+    :return: Dictionary that maps IP => hop, where hop is a packet-like dictionary containing only the IP. Enrichment
+    functions add their information to the hops, which is then copied back to the packets by fan_out_hops.
+    """
+    hops = {}
+    for tr in d3_json['traceroutes']:
+        for packet in tr['packets']:
+            ip = packet.get('ip')
+            if ip and ip not in hops:
+                hops[ip] = {'ip': ip}
+    return hops
+
+
+def fan_out_hops(d3_json, hops):
     """
-    Run all functions which add additional information, i.e. Netbeam and geoIP pieces.
+    Copies the information added to each unique hop back to every packet with the same IP.
+    :param d3_json: JSON formatted for d3. Modified in place, so no return.
+    :param hops: Enriched hops, as returned by unique_hops.
+    """
+    for tr in d3_json['traceroutes']:
+        for packet in tr['packets']:
+            hop = hops.get(packet.get('ip'))
+            if hop is not None:
+                packet.update(hop)
+
+
+def add_additional_information(d3_json, enrich=None):
+    """
+    Run all functions which add additional information, i.e. Netbeam and geoIP pieces. These are registered as
+    providers in d3_enrichment. The lookups are run against the unique hops of the request rather than against every
+    packet, and the results are fanned back out to the packets afterwards.
     :param d3_json: JSON formatted for d3 to add additional information to (i.e. output from system_to_d3_*). All
     functions called here should modify the JSON in place and should not return anything.
+    :param enrich: Names of the providers to run. If None, all registered providers are run.
     :return: Modified version of d3_json.
     """
     remove_unknowns(d3_json)
-    d3_tsds.add_tsds_info_threaded(d3_json)
-    d3_stardust.add_sd_info_threaded(d3_json)
-    d3_geo_ip.add_geo_info_threaded(d3_json)
-    d3_rdap.rdap_cache_threaded(d3_json)
+    hops = unique_hops(d3_json)
+    # The enrichment functions only iterate over traceroutes/packets, so the unique hops are wrapped as a single
+    # traceroute.
+    hop_json = {'traceroutes': [{'packets': list(hops.values())}]}
+    # Runs TSDS, Stardust, geoIP, and RDAP lookups (and any other registered providers) concurrently.
+    d3_enrichment.enrich(hop_json, enrich)
+    fan_out_hops(d3_json, hops)
+    # Filling in unknown locations depends on the order of the hops in each traceroute, so it has to happen after the
+    # results are fanned out. Only done if the geo provider ran; otherwise every hop would get the default location.
+    if enrich is None or 'geo' in enrich:
+        d3_geo_ip.fill_unknown_locations(d3_json)
+    return d3_json
+
+
+def hop_traffic(ip):
+    """
+    Gets the traffic information for a single hop, i.e. for the UI to load when a hop is selected rather than with
+    every traceroute. Runs every provider that adds traffic_info (along with the providers they depend on); the time
+    series are cached (see d3_timeseries), so repeated calls are cheap.
+    :param ip: IP address of the hop.
+    :return: Packet with the traffic information added (traffic_info plus fields such as resource, speed, and
+    max_bandwidth, if available).
+    """
+    packet = {'ip': ip}
+    d3_enrichment.enrich({'traceroutes': [{'packets': [packet]}]}, d3_enrichment.providers_writing('traffic_info'))
+    return packet
+
+
+def traffic_columns(traffic_info):
+    """
+    Converts traffic info (dictionary of key => point, where each point has a ts plus one value per metric) into the
+    columnar format: {'epoch': <ts of the first point>, 'step': <greatest common divisor of the intervals between
+    points>, 'ts': [<(ts - epoch) / step for each point>], <metric>: [<value for each point, None if missing>], ...}.
+    Timestamps keep the units of the source (seconds for TSDS, milliseconds for Stardust). Metric names are only sent
+    once, rather than once per point.
+    :param traffic_info: Traffic info, i.e. from d3_tsds or d3_stardust. Not modified.
+    :return: Columnar traffic info.
+    """
+    points = sorted(traffic_info.values(), key=lambda point: point['ts'])
+    timestamps = [int(point['ts']) for point in points]
+    if not timestamps:
+        return {'epoch': None, 'step': None, 'ts': []}
+
+    epoch = timestamps[0]
+    step = 0
+    for ts in timestamps:
+        step = math.gcd(step, ts - epoch)
+    step = step or 1
+    metrics = sorted({metric for point in points for metric in point if metric != 'ts'})
+
+    columns = {'epoch': epoch, 'step': step, 'ts': [(ts - epoch) // step for ts in timestamps]}
+    for metric in metrics:
+        columns[metric] = [point.get(metric) for point in points]
+    return columns
+
+
+def columnar_traffic(d3_json):
+    """
+    Replaces the traffic info of every packet with the columnar format (see traffic_columns). Packets that share a
+    series (i.e. the same hop in multiple runs) share the converted series too. The original traffic info is cached and
+    shared between requests (see d3_timeseries), so it's replaced on the packets rather than modified.
+    :param d3_json: JSON formatted for d3. Modified in place.
+    :return: d3_json.
+    """
+    # id(traffic info) => columnar traffic info
+    converted = {}
+    for tr in d3_json.get('traceroutes', []):
+        for packet in tr['packets']:
+            traffic_info = packet.get('traffic_info')
+            if traffic_info is None:
+                continue
+            if id(traffic_info) not in converted:
+                converted[id(traffic_info)] = traffic_columns(traffic_info)
+            packet['traffic_info'] = converted[id(traffic_info)]
     return d3_json
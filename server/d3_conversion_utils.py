@@ -3,10 +3,23 @@ Author: Andrew Golightly
 """
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
+import array
+import contextlib
+import fcntl
+import ipaddress
+import mmap
+import os
 import subprocess
 import re
 import socket
+import struct
+import sys
+import tempfile
+import threading
 import time
+from collections import OrderedDict
+
+from server import d3_cache, d3_http
 
 # Disables warnings for insecure requests using requests package
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
@@ -50,12 +63,16 @@ def my_ip():
 
 def ip_to_asn(ip):
     """
-    Looks up ASN from IP address.
+    Looks up ASN from IP address. Results are cached (see d3_cache).
     :param ip: IP address to lookup.
     :return: ASN as JSON/dictionary.
     """
     if ip_validation_regex.match(ip):
-        return requests.get(f'https://api.iptoasn.com/v1/as/ip/{ip}', timeout=6).json()
+        result = d3_cache.get('asn', ip)
+        if result is None:
+            result = d3_http.get(f'https://api.iptoasn.com/v1/as/ip/{ip}', timeout=6).json()
+            d3_cache.put('asn', ip, result)
+        return result
     else:
         return None
 
@@ -69,7 +86,7 @@ def check_pscheduler(endpoint):
     if not endpoint.__contains__('https'):
         endpoint = 'https://' + endpoint
     try:
-        response = requests.get(f'{endpoint}/pscheduler', verify=False, timeout=6).content.decode('utf8')
+        response = d3_http.get(f'{endpoint}/pscheduler', verify=False, timeout=6).content.decode('utf8')
         return response.__contains__('pScheduler API server')
     except:
         pass
@@ -90,3 +107,225 @@ def target_to_ip(target):
             return None
     except:
         return None
+
+
+def ip_to_int(ip):
+    """
+    Converts an IPv4 address to an integer.
+    :param ip: IPv4 address as a string (dotted quad).
+    :return: Integer representation of the IP address.
+    """
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def int_to_ip(ip_int):
+    """
+    Converts an integer to an IPv4 address.
+    :param ip_int: Integer representation of the IP address.
+    :return: IPv4 address as a string (dotted quad).
+    """
+    return socket.inet_ntoa(struct.pack('!I', ip_int))
+
+
+# Packed files store a number of typed arrays (array.array) in a single binary file which can be memory mapped. The file
+# starts with an 8 byte magic value and the number of arrays, followed by the typecode, length, and offset of each
+# array. The arrays are stored in native byte order; loading fails if the byte order doesn't match.
+_packed_header = struct.Struct('<8sBI')
+_packed_entry = struct.Struct('<cBxxIQ')
+
+
+def pack_strings(strings):
+    """
+    Packs a list of strings into two arrays that can be stored in a packed file.
+    :param strings: List of strings.
+    :return: Tuple of (offsets, blob). The i-th string is blob[offsets[i]:offsets[i + 1]] decoded as UTF-8.
+    """
+    offsets = array.array('I', [0])
+    blob = bytearray()
+    for s in strings:
+        blob += s.encode('utf8')
+        offsets.append(len(blob))
+    return offsets, array.array('B', bytes(blob))
+
+
+def unpack_string(offsets, blob, i):
+    """
+    :param offsets: Offsets array created by pack_strings.
+    :param blob: Blob array created by pack_strings.
+    :param i: Index of the string.
+    :return: The i-th string.
+    """
+    return bytes(blob[offsets[i]:offsets[i + 1]]).decode('utf8')
+
+
+def write_packed_file(file_path, magic, arrays):
+    """
+    Writes arrays to a packed file. The file is written to a temporary file and renamed into place, so readers never see
+    a partially written file.
+    :param file_path: Path to the file.
+    :param magic: 8 byte value identifying the type of file.
+    :param arrays: List of array.array.
+    """
+    offset = _packed_header.size + _packed_entry.size * len(arrays)
+    entries = []
+    for a in arrays:
+        # Align each array to 8 bytes.
+        offset += -offset % 8
+        entries.append(_packed_entry.pack(a.typecode.encode(), a.itemsize, len(a), offset))
+        offset += len(a) * a.itemsize
+
+    # Every process may write the same file, so each writer gets its own temporary file.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)),
+                                    prefix=os.path.basename(file_path) + '.', suffix='.tmp')
+    try:
+        with open(fd, 'wb') as f:
+            f.write(_packed_header.pack(magic, sys.byteorder == 'little', len(arrays)))
+            for entry in entries:
+                f.write(entry)
+            for a in arrays:
+                f.write(b'\0' * (-f.tell() % 8))
+                a.tofile(f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def file_lock(file_path):
+    """
+    Non-blocking, exclusive lock on file_path (held on file_path.lock), shared by every process on the host. Used so
+    that only one process rebuilds a shared file at a time.
+    :param file_path: Path to the file being rebuilt.
+    :return: Context manager; True if the lock was acquired, False if another process holds it.
+    """
+    with open(f'{file_path}.lock', 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load_packed_file(file_path, magic):
+    """
+    Memory maps a packed file. The pages are shared between every process that maps the same file.
+    :param file_path: Path to the file.
+    :param magic: 8 byte value identifying the type of file.
+    :return: List of memoryviews, one per array in the file (in the order they were written).
+    """
+    with open(file_path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    file_magic, little_endian, count = _packed_header.unpack_from(mm, 0)
+    if file_magic != magic:
+        raise ValueError(f'{file_path} is not a packed file of the expected type')
+    if bool(little_endian) != (sys.byteorder == 'little'):
+        raise ValueError(f'{file_path} was written with a different byte order')
+
+    view = memoryview(mm)
+    arrays = []
+    for i in range(count):
+        typecode, itemsize, length, offset = _packed_entry.unpack_from(mm, _packed_header.size + _packed_entry.size * i)
+        typecode = typecode.decode()
+        if array.array(typecode).itemsize != itemsize:
+            raise ValueError(f'{file_path} was written with a different item size for {typecode}')
+        arrays.append(view[offset:offset + length * itemsize].cast(typecode))
+    return arrays
+
+
+class PrefixIndex:
+    """
+    Longest prefix match index of IPv4 networks => values. Entries are stored per prefix length, so a lookup checks at
+    most one dictionary per prefix length in use, i.e. O(prefix length).
+    Entries can expire after a TTL, and the index can be capped to a maximum number of entries, in which case the
+    oldest entries are evicted first. Safe to use from multiple threads.
+    """
+
+    def __init__(self, ttl=None, max_entries=None):
+        """
+        :param ttl: Number of seconds before an entry expires. If None, entries don't expire.
+        :param max_entries: Maximum number of entries. If None, the index isn't capped.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # (prefix length, network as int) => (value, expiry time)
+        self._entries = OrderedDict()
+        # prefix length => number of entries with that prefix length.
+        self._length_counts = dict()
+        # Prefix lengths in use, longest first.
+        self._lengths = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        del self._entries[key]
+        self._length_counts[key[0]] -= 1
+        if self._length_counts[key[0]] == 0:
+            del self._length_counts[key[0]]
+            self._lengths.remove(key[0])
+
+    def add(self, network, length, value):
+        """
+        Adds (or replaces) a network.
+        :param network: Network address as an int. Host bits are ignored.
+        :param length: Prefix length, 0-32.
+        :param value: Value returned for IPs within the network.
+        """
+        key = (length, network >> (32 - length) if length else 0)
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires)
+            if length not in self._length_counts:
+                self._length_counts[length] = 0
+                self._lengths.append(length)
+                self._lengths.sort(reverse=True)
+            self._length_counts[length] += 1
+            while self.max_entries is not None and len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def add_range(self, start, end, value):
+        """
+        Adds a range of IPs. Ranges that aren't a single network are split into the smallest number of networks that
+        cover the range exactly.
+        :param start: First IP in the range, as an int.
+        :param end: Last IP in the range, as an int.
+        :param value: Value returned for IPs within the range.
+        """
+        for network in ipaddress.summarize_address_range(ipaddress.IPv4Address(start), ipaddress.IPv4Address(end)):
+            self.add(int(network.network_address), network.prefixlen, value)
+
+    def lookup(self, ip_int):
+        """
+        :param ip_int: IP address as an int.
+        :return: Value of the most specific (longest prefix) network containing the IP, or None if there isn't one.
+        """
+        now = time.time()
+        with self._lock:
+            for length in list(self._lengths):
+                key = (length, ip_int >> (32 - length) if length else 0)
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry[1] is not None and entry[1] < now:
+                    self._remove(key)
+                    continue
+                return entry[0]
+        return None
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._length_counts.clear()
+            self._lengths.clear()
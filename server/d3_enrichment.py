@@ -0,0 +1,144 @@
+"""
+Enrichment pipeline used to add additional information (TSDS, Stardust, geoIP, RDAP, ...) to the hops of a traceroute.
+Each provider declares the hop fields it reads and the hop fields it writes. A provider depends on every provider
+registered before it that writes a field it reads. Each provider starts as soon as the providers it depends on have
+finished, so the time taken is that of the slowest chain of dependent providers rather than the sum of every run time.
+"""
+import threading
+from collections import namedtuple
+from functools import partial
+
+from server import d3_geo_ip, d3_rdap, d3_stardust, d3_tsds
+
+# name: Unique name for the provider.
+# func: Function that accepts d3_json and modifies it in place (same as the other add_*_info functions).
+# reads: Hop fields used by the provider.
+# writes: Hop fields added by the provider.
+Provider = namedtuple('Provider', ['name', 'func', 'reads', 'writes'])
+
+# Registered providers, in registration order.
+providers = []
+# Used to protect providers when registering.
+providers_lock = threading.Lock()
+
+
+def register_provider(name, func, reads=('ip',), writes=()):
+    """
+    Adds a provider to the pipeline. Providers are only able to depend on providers that were registered before them,
+    so the order of registration matters when one provider uses the output of another.
+    Two providers writing the same field are not ordered with respect to each other.
+    :param name: Unique name for the provider. Registering a name that already exists replaces the old provider.
+    :param func: Function that accepts d3_json and modifies it in place.
+    :param reads: Iterable of hop fields used by the provider.
+    :param writes: Iterable of hop fields added by the provider.
+    :return: The registered provider.
+    """
+    provider = Provider(name, func, frozenset(reads), frozenset(writes))
+    with providers_lock:
+        for i, existing in enumerate(providers):
+            if existing.name == name:
+                providers[i] = provider
+                break
+        else:
+            providers.append(provider)
+    return provider
+
+
+def provider_names():
+    """
+    :return: Names of the registered providers, in registration order.
+    """
+    with providers_lock:
+        return [p.name for p in providers]
+
+
+def providers_writing(field):
+    """
+    :param field: Hop field, i.e. traffic_info.
+    :return: Names of the registered providers that write the field.
+    """
+    with providers_lock:
+        return [p.name for p in providers if field in p.writes]
+
+
+def provider_dependencies(names=None):
+    """
+    Works out which providers each provider has to wait for: every earlier provider that writes something it reads.
+    :param names: Names of the providers to include. Providers they depend on are included as well. If None, all
+    registered providers are included.
+    :return: List of (provider, names of the providers it depends on), in registration order.
+    """
+    with providers_lock:
+        if names is None:
+            selected = list(providers)
+        else:
+            # Walk backwards through the registration order, pulling in the providers each selected provider depends on.
+            needed = set(names)
+            selected = []
+            for i in range(len(providers) - 1, -1, -1):
+                provider = providers[i]
+                if provider.name not in needed:
+                    continue
+                selected.insert(0, provider)
+                needed.update(dep.name for dep in providers[:i] if dep.writes & provider.reads)
+
+    return [(provider, [dep.name for dep in selected[:i] if dep.writes & provider.reads])
+            for i, provider in enumerate(selected)]
+
+
+def run_provider(provider, d3_json):
+    """
+    Runs a single provider. Failures are printed rather than raised so that one provider failing doesn't stop the
+    others from adding their information.
+    :param provider: Provider to run.
+    :param d3_json: JSON ingestible by d3. Modified in place.
+    """
+    try:
+        provider.func(d3_json)
+    except Exception as e:
+        print(f'Enrichment provider {provider.name} failed: {e!r}')
+
+
+def enrich(d3_json, names=None):
+    """
+    Runs the enrichment pipeline. Every provider gets its own thread, and starts as soon as the providers it depends on
+    have finished, so the time taken is that of the slowest chain of dependent providers.
+    :param d3_json: JSON ingestible by d3. Modified in place.
+    :param names: Names of the providers to run. If None, all registered providers are run.
+    """
+    dependencies = provider_dependencies(names)
+    if not dependencies:
+        return
+    # Provider name => set once the provider has finished (or failed).
+    finished = {provider.name: threading.Event() for provider, _ in dependencies}
+
+    def run(provider, deps):
+        for dep in deps:
+            finished[dep].wait()
+        try:
+            run_provider(provider, d3_json)
+        finally:
+            finished[provider.name].set()
+
+    threads = []
+    # The last provider is run on the calling thread - no need to spawn a thread just to wait on it.
+    for provider, deps in dependencies[:-1]:
+        thread = threading.Thread(target=run, args=(provider, deps))
+        threads.append(thread)
+        thread.start()
+    run(*dependencies[-1])
+    for thread in threads:
+        thread.join()
+
+
+# Default providers.
+# The Stardust interface lookup is local (no requests), so TSDS waits for it and skips the hops that are Stardust
+# interfaces; TSDS and Stardust traffic then run at the same time without writing traffic_info for the same hops.
+register_provider('stardust_interfaces', d3_stardust.add_sd_interfaces, writes=('resource', 'speed', 'sd_interface_ip'))
+register_provider('tsds', d3_tsds.add_tsds_info_threaded, reads=('ip', 'resource'),
+                  writes=('traffic_info', 'max_bandwidth', 'tsds_interface_ip'))
+register_provider('stardust_traffic', d3_stardust.add_sd_traffic, reads=('resource',), writes=('traffic_info',))
+# Unknown locations are filled in by d3_conversion after the results are fanned out to the packets.
+register_provider('geo', partial(d3_geo_ip.add_geo_info_threaded, fill_unknown=False),
+                  writes=('lat', 'lon', 'city', 'region'))
+register_provider('rdap', d3_rdap.rdap_cache_threaded, writes=('org', 'domain'))
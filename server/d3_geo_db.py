@@ -0,0 +1,150 @@
+"""
+Offline geoIP lookups, used by d3_geo_ip when geo_backend is set to offline in the config file.
+A local IP range => location dataset is compiled into a packed file (see d3_conversion_utils.write_packed_file) made up
+of a sorted array of range starts plus parallel arrays for the range ends and locations. The file is memory mapped, so
+every worker process shares the same pages, and lookups are a binary search over the range starts - no network needed.
+
+Compiling the dataset:
+    python -m server.d3_geo_db <path_to_csv> [<path_to_output>]
+The CSV can be gzipped. Both the DB-IP "IP to City Lite" CSV and the IP2Location LITE DB5 CSV are supported; both use
+the columns start, end, ..., ..., region, city, latitude, longitude. Start and end may be dotted quads or integers.
+IPv6 rows are skipped.
+"""
+import array
+import bisect
+import csv
+import gzip
+import sys
+import threading
+
+from server import config, d3_conversion_utils
+
+GEO_DB_MAGIC = b'TRGEO001'
+
+# Loaded database; see load_geo_db.
+_geo_db = None
+# Used to make sure the database is only loaded once.
+_geo_db_lock = threading.Lock()
+
+
+def _parse_ip(value):
+    """
+    :param value: IP address as either a dotted quad or an integer.
+    :return: Integer representation of the IP address, or None if it isn't an IPv4 address.
+    """
+    if value.isdigit():
+        ip_int = int(value)
+        return ip_int if ip_int <= 0xFFFFFFFF else None
+    if d3_conversion_utils.ip_validation_regex.match(value) or value.startswith('0.'):
+        return d3_conversion_utils.ip_to_int(value)
+    return None
+
+
+def compile_geo_db(csv_path, db_path=None):
+    """
+    Compiles a CSV of IP ranges => locations into a packed file.
+    :param csv_path: Path to the CSV (or gzipped CSV).
+    :param db_path: Path to the output file. If None, uses the path from the config file.
+    :return: Number of ranges written.
+    """
+    if db_path is None:
+        db_path = config.variables['geo_db_file']
+
+    opener = gzip.open if csv_path.endswith('.gz') else open
+    rows = []
+    # (string) => index in the string table. City and region names are heavily repeated, so they are only stored once.
+    strings = {}
+    with opener(csv_path, 'rt', encoding='utf8', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 8:
+                continue
+            start, end = _parse_ip(row[0]), _parse_ip(row[1])
+            if start is None or end is None:
+                continue
+            try:
+                lat, lon = float(row[6]), float(row[7])
+            except ValueError:
+                continue
+            region = strings.setdefault(row[4], len(strings))
+            city = strings.setdefault(row[5], len(strings))
+            rows.append((start, end, lat, lon, city, region))
+
+    rows.sort()
+    offsets, blob = d3_conversion_utils.pack_strings(strings.keys())
+    d3_conversion_utils.write_packed_file(db_path, GEO_DB_MAGIC, [
+        array.array('I', (r[0] for r in rows)),
+        array.array('I', (r[1] for r in rows)),
+        array.array('f', (r[2] for r in rows)),
+        array.array('f', (r[3] for r in rows)),
+        array.array('I', (r[4] for r in rows)),
+        array.array('I', (r[5] for r in rows)),
+        offsets,
+        blob
+    ])
+    return len(rows)
+
+
+def load_geo_db(db_path=None):
+    """
+    Memory maps the compiled database. Replaces the previously loaded database, if any.
+    :param db_path: Path to the compiled database. If None, uses the path from the config file.
+    :return: The loaded database.
+    """
+    global _geo_db
+    if db_path is None:
+        db_path = config.variables['geo_db_file']
+    starts, ends, lats, lons, cities, regions, offsets, blob = \
+        d3_conversion_utils.load_packed_file(db_path, GEO_DB_MAGIC)
+    _geo_db = {
+        'starts': starts,
+        'ends': ends,
+        'lats': lats,
+        'lons': lons,
+        'cities': cities,
+        'regions': regions,
+        'offsets': offsets,
+        'blob': blob
+    }
+    return _geo_db
+
+
+def geo_db_lookup(dest):
+    """
+    Offline version of d3_geo_ip.ip_to_geo. Loads the database on first use.
+    :param dest: Target IP address.
+    :return: JSON with geoIP info; same format as d3_geo_ip.ip_to_geo.
+    """
+    not_found = {
+        'lat': None,
+        'lon': None,
+        'city': None,
+        'region': None
+    }
+    if not d3_conversion_utils.ip_validation_regex.match(dest):
+        return not_found
+
+    db = _geo_db
+    if db is None:
+        with _geo_db_lock:
+            db = _geo_db if _geo_db is not None else load_geo_db()
+
+    ip_int = d3_conversion_utils.ip_to_int(dest)
+    # Last range starting at or before the IP.
+    i = bisect.bisect_right(db['starts'], ip_int) - 1
+    if i < 0 or db['ends'][i] < ip_int:
+        return not_found
+    return {
+        # Stored as 32 bit floats; round to the same precision returned by ip-api.
+        'lat': round(db['lats'][i], 4),
+        'lon': round(db['lons'][i], 4),
+        'city': d3_conversion_utils.unpack_string(db['offsets'], db['blob'], db['cities'][i]) or None,
+        'region': d3_conversion_utils.unpack_string(db['offsets'], db['blob'], db['regions'][i]) or None
+    }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python -m server.d3_geo_db <path_to_csv> [<path_to_output>]')
+        sys.exit(1)
+    count = compile_geo_db(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    print(f'Wrote {count} ranges')
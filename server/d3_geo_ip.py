@@ -1,12 +1,14 @@
 """
 Author: Andrew Golightly
 """
-import requests
-import threading
 import re
-from server import config, d3_conversion_utils
 
-geo_cache = dict()
+import requests
+
+from server import config, d3_cache, d3_conversion_utils, d3_geo_db, d3_http, d3_singleflight, d3_workers
+
+# Maximum number of IPs accepted by the ip-api.com batch endpoint.
+ip_api_batch_size = 100
 
 # Matches private IP Addresses; we don't want to look up the Geo IP information for these.
 # This has been validated to only cover these ranges - this is available in test.py, but it takes forever to run.
@@ -20,34 +22,36 @@ private_ip = re.compile(r'^(10\.((25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9][0-9]|[0-9]
 
 def whois_ip(dest):
     """
-    Lookup using whois and a cache.
+    Lookup using whois and a cache (see d3_cache).
     :param dest: Target IP address.
-    :return: JSON with geoIP information + org.
+    :return: JSON with geoIP information + org. None if the lookup failed.
     """
-    if dest not in geo_cache:
+    result = d3_cache.get('whois', dest)
+    if result is None:
         dest = d3_conversion_utils.target_to_ip(dest)
-        if d3_conversion_utils.ip_validation_regex.match(dest):
-            r = requests.get(f'http://ipwhois.app/json/{dest}')
+        if dest is not None and d3_conversion_utils.ip_validation_regex.match(dest):
+            r = d3_http.get(f'http://ipwhois.app/json/{dest}', timeout=5)
             if r.status_code == 200:
                 json = dict(r.json())
                 if json.keys().__contains__('latitude'):
-                    geo_cache[dest] = {
+                    result = {
                         'lat': float(json['latitude']),
                         'lon': float(json['longitude']),
                         'org': json['org']
                     }
                 else:
-                    geo_cache[dest] = {
+                    result = {
                         'lat': None,
                         'lon': None,
                         'org': None
                     }
-    return geo_cache[dest]
+                d3_cache.put('whois', dest, result)
+    return result
 
 
 def ip_to_geo(dest):
     """
-    Lookup using ip-api.com.
+    Lookup using ip-api.com. Successful lookups are cached (see d3_cache).
     :param dest: Target IP address.
     :return: JSON with geoIP info.
     """
@@ -60,19 +64,97 @@ def ip_to_geo(dest):
     if private_ip.match(dest):
         return not_found
     if d3_conversion_utils.ip_validation_regex.match(dest):
-        r = requests.get(f'http://ip-api.com/json/{dest}', timeout=5)
+        cached = d3_cache.get('geo', dest)
+        if cached is not None:
+            return cached
+        r = d3_http.get(f'http://ip-api.com/json/{dest}', timeout=5)
         if r.status_code == 200:
             json = dict(r.json())
+            result = not_found
             if json.keys().__contains__('lat'):
-                return {
+                result = {
                     'lat': json['lat'],
                     'lon': json['lon'],
                     'city': json['city'],
                     'region': json['region']
                 }
+            d3_cache.put('geo', dest, result)
+            return result
     return not_found
 
 
+def ip_to_geo_batch_tw(ips):
+    """
+    Looks up a single batch of IPs using ip-api.com's batch endpoint.
+    :param ips: List of at most ip_api_batch_size public IP addresses.
+    :return: Dictionary that maps IP => geoIP info (same format as ip_to_geo). IPs missing from the response or in a
+    failed request are left out.
+    """
+    results = {}
+    try:
+        r = d3_http.post('http://ip-api.com/batch?fields=status,query,lat,lon,city,region', json=ips, timeout=5)
+    except requests.exceptions.RequestException:
+        return results
+    if r.status_code != 200:
+        return results
+    for json in r.json():
+        if 'query' not in json:
+            continue
+        # ip-api gives a status of fail for IPs it knows it can't locate (i.e. reserved ranges); retrying those
+        # individually would give the same result, so they are kept as not found.
+        results[json['query']] = {
+            'lat': json.get('lat'),
+            'lon': json.get('lon'),
+            'city': json.get('city'),
+            'region': json.get('region')
+        }
+    return results
+
+
+def ip_to_geo_batch(ips):
+    """
+    Lookup using ip-api.com's batch endpoint. ip-api rate limits requests per IP, so looking up a whole request in one
+    (or as few as possible) batches avoids hitting the rate limit. Only IPs that aren't cached (see d3_cache) are looked
+    up, and IPs already being looked up in a batch (i.e. by another request) are waited on rather than looked up again.
+    Batches are coalesced separately from the single IP lookups (geo_batch rather than geo): the single IP lookups run
+    on the worker pool, so waiting on them here - or having them wait on a batch - could use up the pool.
+    :param ips: Iterable of public IP addresses.
+    :return: Dictionary that maps IP => geoIP info (same format as ip_to_geo). IPs that couldn't be looked up are left
+    out.
+    """
+    ips = list(ips)
+    results = d3_cache.get_many('geo', ips)
+    results.update(d3_singleflight.do_many('geo_batch', [ip for ip in ips if ip not in results],
+                                           ip_to_geo_batch_uncoalesced))
+    return results
+
+
+def ip_to_geo_batch_uncoalesced(ips):
+    """
+    Runs the batch lookups for ip_to_geo_batch and caches the results. The batches are run on the calling thread rather
+    than on the worker pool, since the caller holds the singleflight claim on these IPs (see ip_to_geo_batch).
+    :param ips: List of public IP addresses.
+    :return: Dictionary that maps IP => geoIP info.
+    """
+    results = {}
+    for i in range(0, len(ips), ip_api_batch_size):
+        results.update(ip_to_geo_batch_tw(ips[i:i + ip_api_batch_size]))
+    d3_cache.put_many('geo', results)
+    return results
+
+
+def set_geo_info(packet, res):
+    """
+    Helper method to modify packet in place. Sets the geoIP information.
+    :param packet: Packet to add geoIP info to.
+    :param res: geoIP info, as returned by ip_to_geo.
+    """
+    packet['lon'] = res['lon']
+    packet['lat'] = res['lat']
+    packet['city'] = res['city']
+    packet['region'] = res['region']
+
+
 def add_geo_info_naive(d3_json):
     """
     Single threaded method for adding geoIP information.
@@ -89,12 +171,9 @@ def add_geo_info_tw(packet):
     :param packet: Packet to add geoIP info to.
     """
     if packet.get('ip'):
-        res = ip_to_geo(packet['ip'])
+        res = d3_singleflight.do('geo', packet['ip'], ip_to_geo, packet['ip'])
         if res is not None:
-            packet['lon'] = res['lon']
-            packet['lat'] = res['lat']
-            packet['city'] = res['city']
-            packet['region'] = res['region']
+            set_geo_info(packet, res)
     else:
         packet['lon'] = None
         packet['lat'] = None
@@ -102,27 +181,79 @@ def add_geo_info_tw(packet):
         packet['region'] = None
 
 
-def add_geo_info_threaded(d3_json):
+def add_geo_info_offline(d3_json):
+    """
+    Adds geo info using the local geoIP database (see d3_geo_db). Lookups take microseconds, so no threads are used.
+    :param d3_json: Traceroute json - formatted by d3_conversion.system_to_d3_*
+    :return: True if the geo info was added, False if the local database couldn't be loaded.
+    """
+    try:
+        for tr in d3_json['traceroutes']:
+            for packet in tr['packets']:
+                if packet.get('ip') and not private_ip.match(packet['ip']):
+                    set_geo_info(packet, d3_geo_db.geo_db_lookup(packet['ip']))
+                else:
+                    add_geo_info_tw(packet)
+    except (OSError, ValueError) as e:
+        print(f'Unable to use the local geoIP database, falling back to ip-api: {e}')
+        return False
+    return True
+
+
+def add_geo_info_threaded(d3_json, fill_unknown=True):
     """
-    Multithreaded version to add geo info.
+    Multithreaded version to add geo info. The public IPs are looked up together using ip-api's batch endpoint; only
+    the IPs the batch lookup fails for are looked up individually. Lookups are run on the shared worker pool (see
+    d3_workers).
     :param d3_json: Traceroute json - formatted by d3_conversion.system_to_d3_*
+    :param fill_unknown: If true, packets without a location are given the last known location in their traceroute
+    (see fill_unknown_locations). Should be false if d3_json isn't made up of actual traceroutes, i.e. the unique hops
+    used by d3_conversion.add_additional_information.
     """
-    threads = []
+    if config.variables['geo_backend'] == 'offline' and add_geo_info_offline(d3_json):
+        if fill_unknown:
+            fill_unknown_locations(d3_json)
+        return
+
+    # IP => packets with that IP.
+    lookups = {}
+    futures = []
     for tr in d3_json['traceroutes']:
         for packet in tr['packets']:
-            thread = threading.Thread(target=add_geo_info_tw, args=(packet,))
-            threads.append(thread)
-            thread.start()
-    for thread in threads:
-        thread.join()
+            ip = packet.get('ip')
+            if ip and d3_conversion_utils.ip_validation_regex.match(ip) and not private_ip.match(ip):
+                lookups.setdefault(ip, []).append(packet)
+            else:
+                # Private, invalid, or missing IP - no lookup needed.
+                add_geo_info_tw(packet)
+
+    results = ip_to_geo_batch(lookups.keys())
+
+    for ip, packets in lookups.items():
+        for packet in packets:
+            if ip in results:
+                set_geo_info(packet, results[ip])
+            else:
+                futures.append(d3_workers.submit('geo', add_geo_info_tw, packet))
+    d3_workers.wait_all(futures)
 
+    if fill_unknown:
+        fill_unknown_locations(d3_json)
+
+
+def fill_unknown_locations(d3_json):
+    """
+    Gives packets without a known location the location of the previous known hop in the same traceroute.
+    :param d3_json: Traceroute json with geo info added. Modified in place.
+    """
     for tr in d3_json['traceroutes']:
         # Use the UU Bookstore as an arbitrary "default" until a better one is found
-        last_known = config.variables['default_location']
+        # Copied so that the default location in the config isn't overwritten.
+        last_known = dict(config.variables['default_location'])
 
         # TODO: Assign undefined packets as average of the previous and next defined ones.
         for packet in tr['packets']:
-            if packet['lon'] is not None:
+            if packet.get('lon') is not None:
                 last_known['lon'] = packet['lon']
                 last_known['lat'] = packet['lat']
                 last_known['city'] = packet['city']
@@ -0,0 +1,120 @@
+"""
+Shared HTTP session layer used for all outbound lookups (geoIP, RDAP, TSDS, ASN, pScheduler checks).
+The bare requests.get opens (and closes) a new connection for every call, meaning every hop pays for a new TCP handshake,
+and a TLS handshake on top of that for HTTPS providers. Requests made through this module reuse kept-alive connections
+from per host connection pools.
+requests.Session isn't guaranteed to be thread safe, so each thread gets its own session; the sessions all share the
+same adapter, and therefore the same (thread safe) connection pools.
+"""
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from server import config
+
+# Used to protect the counters below.
+_stats_lock = threading.Lock()
+# host => number of connections taken from the pool (both new and reused).
+_checkouts = dict()
+# host => number of new connections opened.
+_new_connections = dict()
+
+
+def _count(counter, host):
+    with _stats_lock:
+        counter[host] = counter.get(host, 0) + 1
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    """
+    HTTPConnectionPool that keeps track of how many connections are opened vs. reused.
+    """
+
+    def _get_conn(self, timeout=None):
+        _count(_checkouts, self.host)
+        return super()._get_conn(timeout)
+
+    def _new_conn(self):
+        _count(_new_connections, self.host)
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    """
+    HTTPSConnectionPool that keeps track of how many connections are opened vs. reused.
+    """
+
+    def _get_conn(self, timeout=None):
+        _count(_checkouts, self.host)
+        return super()._get_conn(timeout)
+
+    def _new_conn(self):
+        _count(_new_connections, self.host)
+        return super()._new_conn()
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    HTTPAdapter using the counting connection pools.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool
+        }
+
+
+# pool_connections is the number of hosts to keep pools for, pool_maxsize is the number of connections kept per host.
+_adapter = PooledAdapter(pool_connections=config.variables['http_pool_connections'],
+                         pool_maxsize=config.variables['http_pool_maxsize'])
+_local = threading.local()
+
+
+def session():
+    """
+    :return: requests.Session for the calling thread, using the shared connection pools.
+    """
+    if not hasattr(_local, 'session'):
+        s = requests.Session()
+        s.mount('http://', _adapter)
+        s.mount('https://', _adapter)
+        _local.session = s
+    return _local.session
+
+
+def get(url, **kwargs):
+    """
+    Drop in replacement for requests.get.
+    """
+    return session().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    """
+    Drop in replacement for requests.post.
+    """
+    return session().post(url, **kwargs)
+
+
+def stats():
+    """
+    :return: Dictionary with the number of new and reused connections, in total and per host.
+    """
+    with _stats_lock:
+        hosts = {
+            host: {
+                'new': _new_connections.get(host, 0),
+                'reused': checkouts - _new_connections.get(host, 0)
+            } for host, checkouts in _checkouts.items()
+        }
+    return {
+        'pool_connections': config.variables['http_pool_connections'],
+        'pool_maxsize': config.variables['http_pool_maxsize'],
+        'new': sum(h['new'] for h in hosts.values()),
+        'reused': sum(h['reused'] for h in hosts.values()),
+        'hosts': hosts
+    }
@@ -1,19 +1,153 @@
 """
 Author: Andrew Golightly
 """
+import ipaddress
+import json
+import os
+import tempfile
 import threading
+import time
+
 import requests
-from server import d3_conversion_utils
+from server import config, d3_cache, d3_conversion_utils, d3_http, d3_singleflight, d3_workers
+
+# IANA's RDAP bootstrap file; lists the RDAP server for every IPv4 allocation.
+RDAP_BOOTSTRAP_URL = 'https://data.iana.org/rdap/ipv4.json'
+# Used if the bootstrap file isn't available or doesn't cover an IP; ARIN redirects to the other RIRs.
+ARIN_RDAP_URL = 'https://rdap.arin.net/registry/'
+
+# Network => RDAP base URL, loaded from the bootstrap file. See load_rdap_bootstrap.
+rdap_bootstrap = None
+# Time (epoch) rdap_bootstrap was loaded.
+rdap_bootstrap_loaded = 0
+# Used to make sure only one thread loads the bootstrap file at a time.
+rdap_bootstrap_lock = threading.Lock()
 
 # Used for rdap_cache_*
-# Stores previous rdap lookup results in a dictionary
-rdap_cache = dict()
-# Used to protect dictionary (cache) accesses across multiple threads
-rdap_lock = threading.Lock()
+# Stores previous rdap lookup results per network. An RDAP response describes the whole network the IP was registered as
+# part of (startAddress/endAddress or cidr0_cidrs), so any IP within a network we've already looked up is answered from
+# the cache. PrefixIndex is safe to use across multiple threads.
+# This is the in-memory tier; results are also stored in the persistent tier of d3_cache, keyed by network (CIDR).
+rdap_cache = d3_conversion_utils.PrefixIndex(ttl=config.variables['rdap_cache_ttl'],
+                                             max_entries=config.variables['rdap_cache_size'])
 
 # https://datatracker.ietf.org/doc/html/rfc7483
 
 
+def create_rdap_bootstrap_file(file_path=None):
+    """
+    Downloads IANA's RDAP bootstrap file. Written to a temporary file (unique to this process) and renamed into place so
+    a failed download doesn't overwrite a working file.
+    :param file_path: Path to the file. If None, uses the path from the config file.
+    :return: True if the file was downloaded, False otherwise.
+    """
+    if file_path is None:
+        file_path = config.variables['rdap_bootstrap_file']
+    try:
+        r = d3_http.get(RDAP_BOOTSTRAP_URL, timeout=10)
+        if r.status_code != 200 or 'services' not in r.json():
+            return False
+    except (requests.exceptions.RequestException, ValueError):
+        print('Unable to download the RDAP bootstrap file')
+        return False
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)),
+                                    prefix=os.path.basename(file_path) + '.', suffix='.tmp')
+    try:
+        with open(fd, 'wt') as f:
+            f.write(r.text)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return True
+
+
+def load_rdap_bootstrap(file_path=None):
+    """
+    Loads the RDAP bootstrap file into rdap_bootstrap, downloading it first if it doesn't exist or if it is older than
+    rdap_bootstrap_refresh_interval. If the download fails, or another process is already downloading it, the existing
+    file (if any) is used.
+    :param file_path: Path to the file. If None, uses the path from the config file.
+    :return: PrefixIndex of network => RDAP base URL. Empty if the file isn't available.
+    """
+    global rdap_bootstrap, rdap_bootstrap_loaded
+    if file_path is None:
+        file_path = config.variables['rdap_bootstrap_file']
+    if not os.path.exists(file_path) or \
+            time.time() - os.stat(file_path).st_mtime > config.variables['rdap_bootstrap_refresh_interval']:
+        with d3_conversion_utils.file_lock(file_path) as locked:
+            # Check again; another process may have downloaded it while we were checking.
+            if locked and (not os.path.exists(file_path) or time.time() - os.stat(file_path).st_mtime >
+                           config.variables['rdap_bootstrap_refresh_interval']):
+                create_rdap_bootstrap_file(file_path)
+
+    index = d3_conversion_utils.PrefixIndex()
+    try:
+        with open(file_path, 'r') as f:
+            bootstrap = json.loads(f.read())
+        # Each service is [[networks], [urls]].
+        for networks, urls in bootstrap['services']:
+            # Prefer HTTPS.
+            url = next((u for u in urls if u.startswith('https')), urls[0])
+            if not url.endswith('/'):
+                url += '/'
+            for network in networks:
+                address, length = network.split('/')
+                index.add(d3_conversion_utils.ip_to_int(address), int(length), url)
+    except (OSError, ValueError, KeyError) as e:
+        print(f'Unable to load the RDAP bootstrap file: {e!r}')
+
+    rdap_bootstrap = index
+    rdap_bootstrap_loaded = time.time()
+    return index
+
+
+def refresh_rdap_bootstrap(file_path=None):
+    """
+    Reloads the bootstrap file if it hasn't been loaded, if it has changed since it was loaded (i.e. another process
+    downloaded it), or if it is past the refresh interval (in which case it's downloaded again first). Run by
+    d3_refresher.
+    :param file_path: Path to the file. If None, uses the path from the config file.
+    :return: None.
+    """
+    if file_path is None:
+        file_path = config.variables['rdap_bootstrap_file']
+    with rdap_bootstrap_lock:
+        if rdap_bootstrap is None or not os.path.exists(file_path) or \
+                os.stat(file_path).st_mtime > rdap_bootstrap_loaded or \
+                time.time() - os.stat(file_path).st_mtime > config.variables['rdap_bootstrap_refresh_interval']:
+            load_rdap_bootstrap(file_path)
+
+
+def rdap_url(ip):
+    """
+    Gets the URL for an RDAP lookup from the RIR responsible for the IP, so the query doesn't have to be redirected.
+    The bootstrap file is loaded (and kept up to date) by d3_refresher, never here, so requests don't wait on it; until
+    it has been loaded, queries go to ARIN, which redirects them.
+    :param ip: IP address to look up.
+    :return: RDAP URL for the IP.
+    """
+    bootstrap = rdap_bootstrap
+    base_url = bootstrap.lookup(d3_conversion_utils.ip_to_int(ip)) if bootstrap is not None else None
+    return f'{base_url or ARIN_RDAP_URL}ip/{ip}'
+
+
+def vcard_value(ntt, prop):
+    """
+    :param ntt: RDAP entity.
+    :param prop: vCard property, i.e. fn or email.
+    :return: Value of the first matching property in the entity's vCard, or None if it doesn't exist.
+    """
+    try:
+        for item in ntt['vcardArray'][1]:
+            if item[0] == prop:
+                return item[3]
+    except (KeyError, IndexError, TypeError):
+        pass
+    return None
+
+
 def not_found(packet):
     """
     Helper method to modify packet in place. Sets org and domain to None. 
@@ -23,6 +157,159 @@ def not_found(packet):
     packet['domain'] = None
 
 
+def set_rdap_info(packet, result):
+    """
+    Helper method to modify packet in place. Sets org and domain from a cached result.
+    :param packet: Packet to modify.
+    :param result: Dictionary with org and (optionally) domain.
+    """
+    packet['org'] = result['org']
+    # Domain isn't guaranteed, so we need to double check this value.
+    packet['domain'] = result.get('domain')
+
+
+def parse_rdap_response(response):
+    """
+    Gets the org and domain from an RDAP response.
+    :param response: Response from the RDAP server.
+    :return: Dictionary with org and (if found) domain. None if the response is from an unknown NCC.
+    """
+    rdap_json = response.json()
+    result = {'org': None}
+    # ARIN managed networks
+    if response.url.__contains__('arin'):
+        # These for loops cannot be combined; if they are it breaks because it changes the org to an incorrect value
+        for ntt in rdap_json['entities']:
+            # Try to grab the org
+            try:
+                result['org'] = ntt['vcardArray'][1][1][3]
+                break
+            except:
+                pass
+        for ntt in rdap_json['entities']:
+            # Try to grab the domain - primary location
+            try:
+                result['domain'] = ntt['vcardArray'][1][5][3].split('@')[-1]
+                break
+            except:
+                break
+        if 'domain' not in result:
+            for ntt in rdap_json['entities'][0].get('entities', []):
+                # Try to grab domain - secondary location
+                try:
+                    result['domain'] = ntt['vcardArray'][1][5][3].split('@')[-1]
+                    break
+                except:
+                    pass
+    # RIPE managed networks
+    elif response.url.__contains__('ripe'):
+        for ntt in rdap_json['entities']:
+            try:
+                # Lookup org - domain isn't given from RIPE networks.
+                if 'registrant' in ntt['roles']:
+                    result = {'org': ntt['handle'], 'domain': 'unknown'}
+                    break
+            except:
+                pass
+    # APNIC, LACNIC, and AFRINIC managed networks. The registrant (if any) is the org; otherwise the network name is
+    # used. The domain comes from the first email found in the entities.
+    elif any(rir in response.url for rir in ('apnic', 'lacnic', 'afrinic')):
+        entities = list(rdap_json.get('entities', []))
+        for ntt in rdap_json.get('entities', []):
+            entities.extend(ntt.get('entities', []))
+        for ntt in entities:
+            if 'registrant' in ntt.get('roles', []):
+                result['org'] = vcard_value(ntt, 'fn') or ntt.get('handle')
+                break
+        if result['org'] is None:
+            result['org'] = rdap_json.get('name')
+        for ntt in entities:
+            email = vcard_value(ntt, 'email')
+            if email:
+                result['domain'] = email.split('@')[-1]
+                break
+    # Response from unknown NCC.
+    else:
+        return None
+    return result
+
+
+def cache_rdap_result(ip, rdap_json, result):
+    """
+    Adds an RDAP result to the cache for every network described by the response. If the response doesn't describe
+    the network, the result is only cached for the IP itself.
+    :param ip: IP address that was looked up.
+    :param rdap_json: RDAP response.
+    :param result: Result to cache (as returned by parse_rdap_response).
+    """
+    networks = []
+    # cidr0 extension; used by ARIN and RIPE amongst others.
+    for cidr in rdap_json.get('cidr0_cidrs', []):
+        try:
+            networks.append(ipaddress.IPv4Network(f'{cidr["v4prefix"]}/{cidr["length"]}', strict=False))
+        except (KeyError, ValueError):
+            pass
+    if not networks:
+        try:
+            networks.extend(ipaddress.summarize_address_range(ipaddress.IPv4Address(rdap_json['startAddress']),
+                                                              ipaddress.IPv4Address(rdap_json['endAddress'])))
+        except (KeyError, ValueError, TypeError):
+            pass
+    if not networks:
+        networks.append(ipaddress.IPv4Network(f'{ip}/32'))
+
+    for network in networks:
+        rdap_cache.add(int(network.network_address), network.prefixlen, result)
+    d3_cache.put_many('rdap', {str(network): result for network in networks})
+
+
+def rdap_cache_lookup(ip):
+    """
+    Looks up an IP in the in-memory cache. If it isn't found, the persistent tier of d3_cache is checked for every
+    network that could contain the IP (in one query), and the most specific network found is added to the in-memory
+    cache. Counted as a single hit, SQLite hit, or miss in the d3_cache stats.
+    :param ip: IP address to look up.
+    :return: Dictionary with org and (optionally) domain. None if the IP isn't cached.
+    """
+    ip_int = d3_conversion_utils.ip_to_int(ip)
+    result = rdap_cache.lookup(ip_int)
+    if result is not None:
+        d3_cache.record('rdap', hits=1)
+        return result
+
+    candidates = [ipaddress.IPv4Network((ip_int, length), strict=False) for length in range(32, -1, -1)]
+    found = d3_cache.get_many('rdap', [str(network) for network in candidates], count=False)
+    # Candidates are ordered most specific first.
+    for network in candidates:
+        if str(network) in found:
+            rdap_cache.add(int(network.network_address), network.prefixlen, found[str(network)])
+            d3_cache.record('rdap', disk_hits=1)
+            return found[str(network)]
+    d3_cache.record('rdap', misses=1)
+    return None
+
+
+def rdap_lookup(ip):
+    """
+    Looks up the RDAP data for a single IP and caches the result.
+    :param ip: IP address to look up.
+    :return: Dictionary with org and (optionally) domain. None if the lookup failed.
+    """
+    # Another lookup (or another process) may have cached the network since this lookup was queued.
+    result = rdap_cache_lookup(ip)
+    if result is not None:
+        return result
+
+    # Look up org and domain info from the RIR responsible for the IP
+    response = d3_http.get(rdap_url(ip), timeout=5)
+    if response.status_code != 200:
+        return None
+    result = parse_rdap_response(response)
+    if result is not None:
+        cache_rdap_result(ip, response.json(), result)
+    return result
+
+
 def rdap_cache_tw(packet, ip):
     """
     Thread specific work. Each thread looks up the RDAP data for a single packet - the IP is part of the packet but
@@ -36,108 +323,41 @@ def rdap_cache_tw(packet, ip):
         return
 
     try:
-        # Look up org and domain info from ARIN
-        response = requests.get(f'https://rdap.arin.net/registry/ip/{ip}')
-        if response.status_code != 200:
-            not_found(packet)
-            return
-        # ARIN managed networks
-        if response.url.__contains__('arin'):
-            # These for loops cannot be combined; if they are it breaks because it changes the org to an incorrect value
-            for ntt in response.json()['entities']:
-                # Try to grab the org
-                try:
-                    rdap_lock.acquire()
-                    rdap_cache[ip] = {'org': ntt['vcardArray'][1][1][3]}
-                    rdap_lock.release()
-                    break
-                except:
-                    rdap_lock.release()
-                    pass
-            for ntt in response.json()['entities']:
-                # Try to grab the domain - primary location
-                try:
-                    rdap_lock.acquire()
-                    rdap_cache[ip]['domain'] = ntt['vcardArray'][1][5][3].split('@')[-1]
-                    rdap_lock.release()
-                    break
-                except:
-                    rdap_lock.release()
-                    break
-            if 'domain' not in rdap_cache[ip]:
-                for ntt in response.json()['entities'][0]['entities']:
-                    # Try to grab domain - secondary location
-                    try:
-                        rdap_lock.acquire()
-                        rdap_cache[ip]['domain'] = ntt['vcardArray'][1][5][3].split('@')[-1]
-                        rdap_lock.release()
-                        break
-                    except:
-                        rdap_lock.release()
-                        pass
-        # RIPE managed networks
-        elif response.url.__contains__('ripe'):
-            for ntt in response.json()['entities']:
-                try:
-                    # Lookup org - domain isn't given from RIPE networks.
-                    if 'registrant' in ntt['roles']:
-                        rdap_lock.acquire()
-                        rdap_cache[ip] = {'org': ntt['handle'], 'domain': 'unknown'}
-                        rdap_lock.release()
-                        break
-                except:
-                    rdap_lock.release()
-                    pass
-        # Response from unknown NCC - there may be more, but I only ever got responses from RIPE and ARIN.
-        else:
-            not_found(packet)
-            return
-    # If connection fails, call not_found to allow for retries
-    except requests.exceptions.ConnectionError:
+        # If the same IP is already being looked up (i.e. by another request), wait for that lookup instead.
+        result = d3_singleflight.do('rdap', ip, rdap_lookup, ip)
+    # If connection fails (or times out), call not_found to allow for retries
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        not_found(packet)
+        return
+    if result is None:
         not_found(packet)
         return
     # As long as we get a valid response, we should be able to get the org
-    packet['org'] = rdap_cache[ip]['org']
-    # Domain isn't guaranteed, so we need to double check this value. 
-    if 'domain' in rdap_cache[ip]:
-        packet['domain'] = rdap_cache[ip]['domain']
-    else:
-        packet['domain'] = None
-    return
+    set_rdap_info(packet, result)
 
 
 def rdap_cache_threaded(d3_json):
     """
-    Add org and domain information to d3_json.
+    Add org and domain information to d3_json. Lookups are run on the shared worker pool (see d3_workers).
     :param d3_json: JSON ingestible by d3. Modified in place.
     """
-    threads = []
+    futures = []
 
     for tr in d3_json['traceroutes']:
         for packet in tr['packets']:
             # If unknown packet, just set org and domain to None and continue. 
-            if 'ip' not in packet:
-                packet['org'] = None
-                packet['domain'] = None
+            if 'ip' not in packet or not d3_conversion_utils.ip_validation_regex.match(packet['ip']):
+                not_found(packet)
                 continue
             ip = packet.get('ip')
-            rdap_lock.acquire()
-            if ip not in rdap_cache:
-                rdap_lock.release()
-                # Run each packet on its own thread
-                thread = threading.Thread(target=rdap_cache_tw, args=(packet, packet.get('ip'),))
-                threads.append(thread)
-                thread.start()
+            result = rdap_cache.lookup(d3_conversion_utils.ip_to_int(ip))
+            if result is None:
+                # Look up each packet as a separate task
+                futures.append(d3_workers.submit('rdap', rdap_cache_tw, packet, ip))
             else:
-                rdap_lock.release()
-                packet['org'] = rdap_cache[ip]['org']
-                if 'domain' in rdap_cache[ip]:
-                    packet['domain'] = rdap_cache[ip]['domain']
-                else:
-                    packet['domain'] = None
+                set_rdap_info(packet, result)
 
-    for thread in threads:
-        thread.join()
+    d3_workers.wait_all(futures)
 
 
 def rdap_tw(packet):
@@ -154,53 +374,17 @@ def rdap_tw(packet):
         return
 
     try:
-        response = requests.get(f'https://rdap.arin.net/registry/ip/{ip}')
+        response = d3_http.get(rdap_url(ip), timeout=5)
         if response.status_code != 200:
-            return not_found
-        # ARIN managed networks
-        if response.url.__contains__('arin'):
-            print('Received response from ARIN')
-            # These for loops can't be combined - doing so breaks it.
-            for ntt in response.json()['entities']:
-                try:
-                    packet['org'] = ntt['vcardArray'][1][1][3]
-                    break
-                except:
-                    pass
-            for ntt in response.json()['entities']:
-                try:
-                    packet['domain'] = ntt['vcardArray'][1][5][3].split('@')[-1]
-                    break
-                except:
-                    pass
-            # Check secondary location if domain not found.
-            if 'domain' not in packet:
-                for ntt in response.json()['entities'][0]['entities']:
-                    try:
-                        packet['domain'] = ntt['vcardArray'][1][5][3].split('@')[-1]
-                        break
-                    except:
-                        pass
-            return
-        # RIPE managed networks
-        elif response.url.__contains__('ripe'):
-            print('Received response from RIPE')
-            for ntt in response.json()['entities']:
-                try:
-                    if 'registrant' in ntt['roles']:
-                        # No consistent way to find domain in RIPE managed networks, so we skip over it.
-                        packet['org'] = ntt['handle']
-                        packet['domain'] = None
-                        break
-                except:
-                    pass
+            not_found(packet)
             return
-        # TODO: Add lacnic, afrinic, apnic ncc/rir (https://www.iana.org/numbers)
-        else:
+        result = parse_rdap_response(response)
+        if result is None:
             print(f'Received response from unknown NCC; {response.url}')
             not_found(packet)
             return
-    except requests.exceptions.ConnectionError:
+        set_rdap_info(packet, result)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
         not_found(packet)
         return
 
@@ -210,11 +394,8 @@ def rdap_threaded(d3_json):
     Threaded version of RDAP lookup WITHOUT using cache. Adds domain and org info.
     :param d3_json: JSON ingestible by d3. Modified in place.
     """
-    threads = []
+    futures = []
     for tr in d3_json['traceroutes']:
         for packet in tr['packets']:
-            thread = threading.Thread(target=rdap_tw, args=(packet,))
-            threads.append(thread)
-            thread.start()
-    for thread in threads:
-        thread.join()
+            futures.append(d3_workers.submit('rdap', rdap_tw, packet))
+    d3_workers.wait_all(futures)
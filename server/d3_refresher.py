@@ -0,0 +1,138 @@
+"""
+Background refresher for the metadata the enrichment modules depend on (the Stardust interface map, the TSDS
+enablement table, and the RDAP bootstrap file), so that API requests never wait on a metadata refresh.
+Jobs are run on the shared worker pool (see d3_workers) on a timer. Each run is scheduled with a random jitter
+(refresh_jitter in the config file), so that the worker processes on a host don't all refresh at the same moment; the
+refreshed data is shared through files/databases, so the first process to refresh usually does the work for the rest,
+and the other processes pick it up on their next check (i.e. reload_interface_map, tsds_index_sync).
+Each job publishes its results by replacing a reference (or a file), never by modifying data in place.
+"""
+import random
+import threading
+import time
+
+from server import config, d3_rdap, d3_stardust, d3_tsds, d3_workers
+
+# Used to protect the jobs below.
+_lock = threading.Lock()
+# Signalled when a job is registered, so the scheduler can recompute when to wake up.
+_wakeup = threading.Event()
+# name => {'func': ..., 'interval': ..., 'next_run': ..., 'running': ..., 'runs': ..., 'failures': ...,
+# 'last_run': ..., 'last_duration': ...}
+_jobs = dict()
+# Scheduler thread; see start.
+_scheduler = None
+
+
+def _jittered(interval):
+    """
+    :return: interval, plus or minus up to refresh_jitter (a fraction of the interval).
+    """
+    jitter = config.variables['refresh_jitter']
+    return interval * (1 + random.uniform(-jitter, jitter))
+
+
+def register_job(name, func, interval, run_now=False):
+    """
+    Registers (or replaces) a job.
+    :param name: Job name.
+    :param func: Function to run. Runs on the shared worker pool, so it must not wait on other work submitted to the
+    pool.
+    :param interval: Number of seconds between runs.
+    :param run_now: If True, the first run happens within refresh_startup_jitter seconds of the scheduler starting (a
+    random delay, so the processes on a host don't all run the job at once); otherwise it happens after a random
+    fraction of the interval.
+    """
+    first_run = config.variables['refresh_startup_jitter'] if run_now else interval
+    with _lock:
+        _jobs[name] = {
+            'func': func,
+            'interval': interval,
+            'next_run': time.time() + random.uniform(0, first_run),
+            'running': False,
+            'runs': 0,
+            'failures': 0,
+            'last_run': None,
+            'last_duration': None
+        }
+    _wakeup.set()
+
+
+def _run(name, job):
+    """
+    Runs a single job, and schedules its next run once it finishes.
+    """
+    start = time.time()
+    failed = False
+    try:
+        job['func']()
+    except Exception as e:
+        failed = True
+        print(f'Refresh job {name} failed: {e!r}')
+    finally:
+        with _lock:
+            job['running'] = False
+            job['runs'] += 1
+            job['failures'] += failed
+            job['last_run'] = start
+            job['last_duration'] = time.time() - start
+            job['next_run'] = time.time() + _jittered(job['interval'])
+        _wakeup.set()
+
+
+def _schedule():
+    """
+    Scheduler loop; submits jobs to the worker pool when they're due.
+    """
+    while True:
+        # Cleared before checking what's due, so a job registered or finished while we check isn't missed.
+        _wakeup.clear()
+        now = time.time()
+        due = []
+        with _lock:
+            for name, job in _jobs.items():
+                if not job['running'] and job['next_run'] <= now:
+                    job['running'] = True
+                    due.append((name, job))
+            waits = [job['next_run'] - now for job in _jobs.values() if not job['running']]
+        for name, job in due:
+            d3_workers.submit('refresher', _run, name, job)
+        _wakeup.wait(max(0, min(waits, default=60)))
+
+
+def start():
+    """
+    Starts the scheduler thread, if it isn't already running.
+    """
+    global _scheduler
+    with _lock:
+        if _scheduler is None:
+            _scheduler = threading.Thread(target=_schedule, name='refresher', daemon=True)
+            _scheduler.start()
+
+
+def stats():
+    """
+    :return: Dictionary of job name => number of runs, number of failures, time of the last run, duration of the last
+    run, and time of the next run (seconds since epoch).
+    """
+    with _lock:
+        return {
+            name: {
+                'running': job['running'],
+                'runs': job['runs'],
+                'failures': job['failures'],
+                'last_run': job['last_run'],
+                'last_duration': job['last_duration'],
+                'next_run': job['next_run']
+            } for name, job in _jobs.items()
+        }
+
+
+# Default jobs.
+register_job('stardust_interfaces', d3_stardust.refresh_interface_map,
+             config.variables['sd_interface_check_interval'], run_now=True)
+register_job('tsds_stale_rows', d3_tsds.refresh_stale_rows, config.variables['tsds_refresh_check_interval'])
+register_job('tsds_index', d3_tsds.tsds_index_sync, config.variables['tsds_index_check_interval'])
+register_job('rdap_bootstrap', d3_rdap.refresh_rdap_bootstrap, config.variables['rdap_bootstrap_check_interval'],
+             run_now=True)
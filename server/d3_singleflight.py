@@ -0,0 +1,147 @@
+"""
+In-flight request coalescing for the enrichment lookups. A lookup is keyed by (provider, key) - usually the IP. If a
+lookup for the same key is already in flight (from another packet, or from another API request), the caller waits for
+that lookup's result instead of making a duplicate request. Waits are capped at singleflight_timeout seconds (see the
+config file), so a lookup that never finishes can't hold up its waiters forever.
+"""
+import threading
+from concurrent.futures import Future, TimeoutError
+
+from server import config
+
+# Used to protect the dictionaries below.
+_lock = threading.Lock()
+# (provider, key) => Future for the lookup in flight.
+_in_flight = dict()
+# provider => number of lookups requested.
+_calls = dict()
+# provider => number of lookups that waited on a lookup already in flight.
+_coalesced = dict()
+# provider => number of waits that timed out.
+_timeouts = dict()
+
+
+def _claim(provider, key):
+    """
+    Must be called with _lock held.
+    :return: Tuple of (future, owner). If owner is True, the caller is responsible for running the lookup and setting
+    the future's result.
+    """
+    _calls[provider] = _calls.get(provider, 0) + 1
+    future = _in_flight.get((provider, key))
+    if future is not None:
+        _coalesced[provider] = _coalesced.get(provider, 0) + 1
+        return future, False
+    future = Future()
+    _in_flight[(provider, key)] = future
+    return future, True
+
+
+def _wait(provider, future):
+    """
+    Waits for a lookup in flight.
+    :return: Result of the lookup. Raises TimeoutError if the lookup doesn't finish within singleflight_timeout.
+    """
+    try:
+        return future.result(timeout=config.variables['singleflight_timeout'])
+    except TimeoutError:
+        with _lock:
+            _timeouts[provider] = _timeouts.get(provider, 0) + 1
+        raise
+
+
+def do(provider, key, fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) unless a lookup for (provider, key) is already in flight, in which case the result of that
+    lookup is returned instead.
+    :param provider: Provider name, i.e. rdap or geo.
+    :param key: Lookup key, i.e. the IP address.
+    :param fn: Function that does the lookup.
+    :return: Result of the lookup. Exceptions raised by the lookup are raised for every caller waiting on it. If the
+    lookup in flight times out, fn is run again by the caller.
+    """
+    with _lock:
+        future, owner = _claim(provider, key)
+    if not owner:
+        try:
+            return _wait(provider, future)
+        except TimeoutError:
+            return fn(*args, **kwargs)
+
+    try:
+        result = fn(*args, **kwargs)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _lock:
+            del _in_flight[(provider, key)]
+
+
+def do_many(provider, keys, fn):
+    """
+    Batched version of do. Keys that are already in flight are waited on; fn is called once with the rest. Keys whose
+    lookup in flight times out are left out of the results.
+    :param provider: Provider name, i.e. rdap or geo.
+    :param keys: Iterable of lookup keys.
+    :param fn: Function that accepts a list of keys and returns a dictionary of key => result. Keys missing from the
+    dictionary are treated as failed lookups.
+    :return: Dictionary of key => result for every key with a result.
+    """
+    owned = {}
+    waiting = {}
+    with _lock:
+        for key in keys:
+            future, owner = _claim(provider, key)
+            if owner:
+                owned[key] = future
+            else:
+                waiting[key] = future
+
+    results = {}
+    if owned:
+        try:
+            results = fn(list(owned))
+        except BaseException as e:
+            for future in owned.values():
+                future.set_exception(e)
+            raise
+        else:
+            for key, future in owned.items():
+                future.set_result(results.get(key))
+        finally:
+            with _lock:
+                for key in owned:
+                    del _in_flight[(provider, key)]
+
+    results = {key: results[key] for key in owned if results.get(key) is not None}
+    for key, future in waiting.items():
+        try:
+            result = _wait(provider, future)
+        except Exception:
+            continue
+        if result is not None:
+            results[key] = result
+    return results
+
+
+def stats():
+    """
+    :return: Dictionary of provider => number of lookups requested, number coalesced, number of waits that timed out,
+    and number in flight.
+    """
+    with _lock:
+        in_flight = {}
+        for provider, _ in _in_flight:
+            in_flight[provider] = in_flight.get(provider, 0) + 1
+        return {
+            provider: {
+                'calls': calls,
+                'coalesced': _coalesced.get(provider, 0),
+                'timeouts': _timeouts.get(provider, 0),
+                'in_flight': in_flight.get(provider, 0)
+            } for provider, calls in _calls.items()
+        }
@@ -1,22 +1,92 @@
+import array
+import bisect
 import json
 import stat
-import threading
+import tempfile
 import time
-from os import chmod, path, stat as osstat
+from os import chmod, path, remove, replace, stat as osstat
 
 import elasticsearch
 
-from server import config
+from server import config, d3_conversion_utils, d3_geo_ip, d3_timeseries
 
 es = elasticsearch.Elasticsearch(hosts=['https://el.gc1.prod.stardust.es.net:9200'], timeout=30)
 
 
-def sd_traffic(resource='lond-cr5::to_tenet_ip-b'):
+# Goes from stardust api values to the values used by d3/other vis.
+sd_key_map = {
+    'values.in_bits.delta': 'traffic_in',
+    'values.out_bits.delta': 'traffic_out',
+
+    'values.in_discards.delta': 'discards_in',
+    'values.out_discards.delta': 'discards_out',
+
+    'values.in_errors.delta': 'errors_in',
+    'values.out_errors.delta': 'errors_out',
+
+    'values.in_ucast_pkts.delta': 'unicast_packets_in',
+    'values.out_ucast_pkts.delta': 'unicast_packets_out',
+
+    'values.in_bcast_pkts.delta': 'broadcast_packets_in',
+    'values.out_bcast_pkts.delta': 'broadcast_packets_out',
+
+    'values.in_mcast_pkts.delta': 'multicast_packets_in',
+    'values.out_mcast_pkts.delta': 'multicast_packets_out',
+
+    'values.in_pkts.delta': 'packets_in',
+    'values.out_pkts.delta': 'packets_out'
+}
+
+# Fields requested from stardust.
+sd_fields = [
+    'values.in_bits.delta',
+    'values.out_bits.delta',
+
+    'values.in_discards.delta',
+    'values.out_discards.delta',
+
+    'values.in_errors.delta',
+    'values.out_errors.delta',
+
+    'values.in_ucast_pkts.delta',
+    'values.out_ucast_pkts.delta',
+
+    # 'values.in_bcast_pkts.delta',
+    # 'values.in_mcast_pkts.delta',
+
+    'values.in_pkts.delta',
+    'values.out_pkts.delta',
+]
+
+# No idea why, but we need to scale everything down from stardust 30x.
+sd_denominator = 30
+
+# Number of interfaces per page when building the interface file.
+sd_interface_page_size = 1000
+
+SD_INDEX_MAGIC = b'TRSDIX02'
+
+# Interface index (see compile_interface_index) held in memory, and the mtime of the file it was loaded from. The index
+# is replaced by refresh_interface_map (run by d3_refresher), never modified, so requests can read it without locking.
+_sd_index = None
+_sd_index_mtime = None
+
+
+def sd_traffic_batch(resources, since=None):
+    """
+    Gets the traffic time series for multiple Stardust interfaces with a single search.
+    :param resources: List of Stardust interfaces (meta.id).
+    :param since: Seconds since epoch to start from. If None, gets the last 15 minutes.
+    :return: Dictionary of resource => (dictionary of ts (milliseconds since epoch) => traffic info, None) for every
+    resource with traffic info; the format used by d3_timeseries.
+    """
+    start = {'gte': int(since * 1000)} if since is not None else {'gte': 'now-15m/m'}
     try:
         r = es.search(index='sd_public_interfaces',
                       body=
                       {
-                          'size': 60,
+                          # 60 hits per resource covers the 15 minute window.
+                          'size': 60 * len(resources),
                           '_source': False,
                           'sort': [
                               {
@@ -25,137 +95,425 @@ def sd_traffic(resource='lond-cr5::to_tenet_ip-b'):
                                   }
                               }
                           ],
-                          'fields': [
-                              'values.in_bits.delta',
-                              'values.out_bits.delta',
+                          'fields': ['meta.id'] + sd_fields,
+                          'query': {
+                              'bool': {
+                                  'filter': [
+                                      {'range': {'start': {
+                                          **start,
+                                          'lte': 'now'
+                                      }}},
+                                      {'terms': {'meta.id': list(resources)}}
+                                  ]
+                              }
+                          }
+                      })
+    except elasticsearch.exceptions.ConnectionTimeout:
+        return {}
 
-                              'values.in_discards.delta',
-                              'values.out_discards.delta',
+    hits = r['hits']['hits']
 
-                              'values.in_errors.delta',
-                              'values.out_errors.delta',
+    # resource => ts => traffic info
+    ret = {}
+
+    for hit in hits:
+        try:
+            fields = dict(hit['fields'])
+            resource = fields.pop('meta.id')[0]
+            ts = hit['sort'][0]
+
+            traffic_info = ret.setdefault(resource, {})
+            if ts not in traffic_info.keys():
+                traffic_info[ts] = {'ts': ts}
+            for key in fields.keys():
+                ret_key = sd_key_map[key]
+                if ret_key in traffic_info[ts].keys():
+                    # On 5 minute intervals (i.e. xx:00, xx:05, etc) the discards, errors, etc. are available.
+                    # For whatever reason, there is a "preliminary" packet that contains roughly half the traffic
+                    # information, and only the traffic information. Then, after the discards & errors are available,
+                    # we get a second packet with the rest of the traffic information + the discards and everything else
+                    # If we don't do the += it's just inaccurate.
+                    traffic_info[ts][ret_key] += fields[key][0]
+                else:
+                    traffic_info[ts][ret_key] = fields[key][0]
+        except KeyError:
+            print(f'KeyError with {hit}')
+            continue
+    for traffic_info in ret.values():
+        for ts in traffic_info.keys():
+            for key in traffic_info[ts].keys():
+                if key.startswith('traffic'):
+                    traffic_info[ts][key] /= sd_denominator
 
-                              'values.in_ucast_pkts.delta',
-                              'values.out_ucast_pkts.delta',
+    return {resource: (traffic_info, None) for resource, traffic_info in ret.items() if traffic_info}
 
-                              # 'values.in_bcast_pkts.delta',
-                              # 'values.in_mcast_pkts.delta',
 
-                              'values.in_pkts.delta',
-                              'values.out_pkts.delta',
-                          ],
+def sd_traffic_histogram(resources, since=None, window=900, interval=60):
+    """
+    Aggregated version of sd_traffic_batch; used when sd_traffic_mode is set to histogram in the config file. Instead of
+    returning the raw hits, stardust returns a date histogram on start per resource, with each metric summed per bucket.
+    This merges the preliminary and final documents for each timestamp, and makes the response a single bucket per
+    interval no matter how many hits there are - longer windows can be requested at a coarser interval.
+    :param resources: List of Stardust interfaces (meta.id).
+    :param since: Seconds since epoch to start from. If None, gets the last window seconds.
+    :param window: Number of seconds to get if since is None.
+    :param interval: Bucket size (s). Traffic is scaled to the same per minute values as sd_traffic_batch regardless of
+    the bucket size.
+    :return: Same format as sd_traffic_batch.
+    """
+    start = {'gte': int(since * 1000)} if since is not None else {'gte': f'now-{window}s/m'}
+    metrics = {}
+    for field in sd_fields:
+        metrics[sd_key_map[field]] = {'sum': {'field': field}}
+        # Sums are 0 for buckets without the metric (i.e. discards outside of 5 minute intervals), so the number of
+        # values is used to leave those out, the same as sd_traffic_batch.
+        metrics[f'{sd_key_map[field]}_count'] = {'value_count': {'field': field}}
+    try:
+        r = es.search(index='sd_public_interfaces',
+                      body=
+                      {
+                          'size': 0,
                           'query': {
                               'bool': {
                                   'filter': [
                                       {'range': {'start': {
-                                          'gte': 'now-15m/m',
+                                          **start,
                                           'lte': 'now'
                                       }}},
-                                      {'term': {'meta.id': resource}}
+                                      {'terms': {'meta.id': list(resources)}}
                                   ]
                               }
+                          },
+                          'aggs': {
+                              'resources': {
+                                  'terms': {'field': 'meta.id', 'size': len(resources)},
+                                  'aggs': {
+                                      'traffic': {
+                                          'date_histogram': {
+                                              'field': 'start',
+                                              'fixed_interval': f'{interval}s',
+                                              'min_doc_count': 1
+                                          },
+                                          'aggs': metrics
+                                      }
+                                  }
+                              }
                           }
                       })
+    except elasticsearch.exceptions.ConnectionTimeout:
+        return {}
+
+    denominator = sd_denominator * interval / 60
+    ret = {}
+    for resource_bucket in r['aggregations']['resources']['buckets']:
+        traffic_info = {}
+        for bucket in resource_bucket['traffic']['buckets']:
+            ts = bucket['key']
+            traffic_info[ts] = {'ts': ts}
+            for field in sd_fields:
+                ret_key = sd_key_map[field]
+                if bucket[f'{ret_key}_count']['value'] > 0:
+                    value = bucket[ret_key]['value']
+                    traffic_info[ts][ret_key] = value / denominator if ret_key.startswith('traffic') else value
+        if traffic_info:
+            ret[resource_bucket['key']] = (traffic_info, None)
+
+    return ret
+
+
+def sd_traffic(resource='lond-cr5::to_tenet_ip-b', since=None):
+    """
+    Gets the traffic time series for a single Stardust interface.
+    :param resource: Stardust interface (meta.id).
+    :param since: Seconds since epoch to start from. If None, gets the last 15 minutes.
+    :return: Dictionary of ts (milliseconds since epoch) => traffic info, or None if there isn't any.
+    """
+    result = sd_traffic_batch([resource], since).get(resource)
+    return result[0] if result is not None else None
 
-        hits = r['hits']['hits']
 
-        # Goes from stardust api values to the values used by d3/other vis.
-        key_map = {
-            'values.in_bits.delta': 'traffic_in',
-            'values.out_bits.delta': 'traffic_out',
+def add_sd_info_threaded(d3_json, source_path=None):
+    """
+    Adds Stardust information (see add_sd_interfaces and add_sd_traffic) to every packet with an IP found in the
+    Stardust interface file.
+    :param d3_json: JSON ingestible by d3. Modified in place.
+    :param source_path: Path to the Stardust interface file. If None, uses the in-memory interface index (see
+    lookup_interface).
+    """
+    add_sd_interfaces(d3_json, source_path)
+    add_sd_traffic(d3_json)
 
-            'values.in_discards.delta': 'discards_in',
-            'values.out_discards.delta': 'discards_out',
 
-            'values.in_errors.delta': 'errors_in',
-            'values.out_errors.delta': 'errors_out',
+def add_sd_interfaces(d3_json, source_path=None):
+    """
+    Adds the Stardust interface (resource) and its speed to every packet with an IP found in the Stardust interface
+    file. Doesn't make any requests.
+    :param d3_json: JSON ingestible by d3. Modified in place.
+    :param source_path: Path to the Stardust interface file. If None, uses the in-memory interface index (see
+    lookup_interface).
+    """
+    lookup = load_stardust_file(source_path).get if source_path is not None else lookup_interface
 
-            'values.in_ucast_pkts.delta': 'unicast_packets_in',
-            'values.out_ucast_pkts.delta': 'unicast_packets_out',
+    for tr in d3_json['traceroutes']:
+        for packet in tr['packets']:
+            sd_item = lookup(packet.get('ip'))
+            if sd_item:
+                packet['resource'] = sd_item['resource']
+                packet['speed'] = sd_item['speed']
+                if 'interface_ip' in sd_item:
+                    packet['sd_interface_ip'] = sd_item['interface_ip']
 
-            'values.in_bcast_pkts.delta': 'broadcast_packets_in',
-            'values.out_bcast_pkts.delta': 'broadcast_packets_out',
 
-            'values.in_mcast_pkts.delta': 'multicast_packets_in',
-            'values.out_mcast_pkts.delta': 'multicast_packets_out',
+def add_sd_traffic(d3_json):
+    """
+    Adds Stardust traffic information to every packet with a resource (see add_sd_interfaces). Traffic for every
+    resource is fetched with a single search (see sd_traffic_batch and sd_traffic_histogram), through the time series
+    cache (see d3_timeseries).
+    :param d3_json: JSON ingestible by d3. Modified in place.
+    """
+    # resource => packets on that interface
+    matched = {}
+    for tr in d3_json['traceroutes']:
+        for packet in tr['packets']:
+            if packet.get('resource'):
+                matched.setdefault(packet['resource'], []).append(packet)
 
-            'values.in_pkts.delta': 'packets_in',
-            'values.out_pkts.delta': 'packets_out'
-        }
+    if not matched:
+        return
 
-        ret = {}
-
-        # No idea why, but we need to scale everything down from stardust 30x.
-        denominator = 30
-
-        for hit in hits:
-            try:
-                fields = hit['fields']
-                keys = fields.keys()
-                ts = hit['sort'][0]
-
-                if ts not in ret.keys():
-                    ret[ts] = {'ts': ts}
-                for key in keys:
-                    ret_key = key_map[key]
-                    if ret_key in ret[ts].keys():
-                        # On 5 minute intervals (i.e. xx:00, xx:05, etc) the discards, errors, etc. are available.
-                        # For whatever reason, there is a "preliminary" packet that contains roughly half the traffic
-                        # information, and only the traffic information. Then, after the discards & errors are available,
-                        # we get a second packet with the rest of the traffic information + the discards and everything else
-                        # If we don't do the += it's just inaccurate.
-                        ret[ts][ret_key] += fields[key][0]
-                    else:
-                        ret[ts][ret_key] = fields[key][0]
-            except KeyError:
-                print(f'KeyError with {hit}')
-                continue
-        for ts in ret.keys():
-            for key in ret[ts].keys():
-                if key.startswith('traffic'):
-                    ret[ts][key] /= denominator
+    # Discards, errors, etc. are added to the buckets on 5 minute intervals, so refreshes start 5 minutes before the
+    # newest cached bucket.
+    fetch = sd_traffic_histogram if config.variables['sd_traffic_mode'] == 'histogram' else sd_traffic_batch
+    series = d3_timeseries.get_many('stardust', matched, fetch, ts_scale=1000, overlap=300)
+    for resource, (traffic_info, _) in series.items():
+        for packet in matched[resource]:
+            packet['traffic_info'] = traffic_info
 
-        if len(ret.keys()) == 0:
-            return None
-        else:
-            return ret
 
-    except elasticsearch.exceptions.ConnectionTimeout:
+def compile_interface_index(sd_map, index_path=None):
+    """
+    Compiles the interface map into a packed file (see d3_conversion_utils.write_packed_file): a sorted array of IPs,
+    plus parallel arrays of resource ids, speeds, and the prefix lengths of the links the interfaces are on (0 if
+    unknown), and the distinct known prefix lengths. Resource names are stored once in a string table.
+    :param sd_map: Dictionary that maps IP => { resource : <value>, speed : <value> }, plus prefix : <value> if the
+    prefix length is known.
+    :param index_path: Path to the output file. If None, uses the path from the config file.
+    :return: Number of interfaces written.
+    """
+    if index_path is None:
+        index_path = config.variables['sd_interface_index_file']
+    rows = sorted((d3_conversion_utils.ip_to_int(ip), item) for ip, item in sd_map.items()
+                  if d3_conversion_utils.ip_validation_regex.match(ip))
+    # resource => index in the string table.
+    strings = {}
+    for _, item in rows:
+        strings.setdefault(item['resource'], len(strings))
+    offsets, blob = d3_conversion_utils.pack_strings(strings.keys())
+    prefixes = array.array('B', (int(r[1].get('prefix') or 0) for r in rows))
+    d3_conversion_utils.write_packed_file(index_path, SD_INDEX_MAGIC, [
+        array.array('I', (r[0] for r in rows)),
+        array.array('I', (strings[r[1]['resource']] for r in rows)),
+        # -1 for unknown speeds.
+        array.array('q', (int(r[1]['speed']) if r[1]['speed'] is not None else -1 for r in rows)),
+        prefixes,
+        array.array('B', sorted(set(prefixes) - {0}, reverse=True)),
+        offsets,
+        blob
+    ])
+    return len(rows)
+
+
+def load_interface_index(index_path=None):
+    """
+    Memory maps a compiled interface index. Nothing is built per process, so loading takes about the same time no matter
+    how many interfaces there are.
+    :param index_path: Path to the compiled index. If None, uses the path from the config file.
+    :return: The loaded index.
+    """
+    if index_path is None:
+        index_path = config.variables['sd_interface_index_file']
+    ips, resources, speeds, prefixes, lengths, offsets, blob = \
+        d3_conversion_utils.load_packed_file(index_path, SD_INDEX_MAGIC)
+    return {
+        'ips': ips,
+        'resources': resources,
+        'speeds': speeds,
+        'prefixes': prefixes,
+        # Prefix lengths to check for links, longest first; interfaces with unknown prefix lengths use the one from the
+        # config file.
+        'lengths': sorted(set(lengths) | {config.variables['interface_link_prefix']}, reverse=True),
+        'offsets': offsets,
+        'blob': blob
+    }
+
+
+def _link_position(index, ip_int):
+    """
+    Finds the interface on the same link as the IP address; the interface's prefix length if it's known, or
+    interface_link_prefix from the config file if it isn't. Longer prefixes are checked first. For each prefix length,
+    the interfaces within the IP's network are found by bisecting the sorted IP array.
+    :param index: Interface index (see load_interface_index).
+    :param ip_int: IP address as an int.
+    :return: Position of the interface in the index arrays, or None if there isn't one.
+    """
+    ips = index['ips']
+    prefixes = index['prefixes']
+    default = config.variables['interface_link_prefix']
+    for length in index['lengths']:
+        if length >= 32:
+            continue
+        mask = (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF
+        network = ip_int & mask
+        broadcast = network | (~mask & 0xFFFFFFFF)
+        i = bisect.bisect_left(ips, network)
+        while i < len(ips) and ips[i] <= broadcast:
+            if ips[i] != ip_int and (prefixes[i] or default) == length:
+                return i
+            i += 1
+    return None
+
+
+def lookup_interface(ip):
+    """
+    Finds the Stardust interface with the IP address. If there isn't one, finds the interface on the other end of the
+    point to point link the IP address is on (see _link_position); traceroute often reports the far side of the link
+    rather than the monitored interface. Private (RFC 1918) addresses are reused across networks, so they're only
+    matched exactly.
+    :param ip: IP address.
+    :return: { resource : <value>, speed : <value> } for the interface, or None. Interfaces found by their link also
+    have interface_ip, the IP address of the interface.
+    """
+    index = _sd_index
+    if index is None or not ip or ip.count('.') != 3:
         return None
+    try:
+        ip_int = d3_conversion_utils.ip_to_int(ip)
+    except OSError:
+        return None
+    i = bisect.bisect_left(index['ips'], ip_int)
+    exact = i < len(index['ips']) and index['ips'][i] == ip_int
+    if not exact:
+        if d3_geo_ip.private_ip.match(ip):
+            return None
+        i = _link_position(index, ip_int)
+        if i is None:
+            return None
+    speed = index['speeds'][i]
+    sd_item = {
+        'resource': d3_conversion_utils.unpack_string(index['offsets'], index['blob'], index['resources'][i]),
+        'speed': speed if speed >= 0 else None
+    }
+    if not exact:
+        sd_item['interface_ip'] = d3_conversion_utils.int_to_ip(index['ips'][i])
+    return sd_item
 
 
-def add_sd_info_tw(packet, sd_item):
+def _index_current(index_path):
+    """
+    :return: True if the compiled index at index_path is in the current format.
     """
-    Adds netbeam information given the netbeam_cache entry and a single packet. Helper function for both the naive and
-    threaded implementations for both styles of lookup.
+    try:
+        with open(index_path, 'rb') as f:
+            return f.read(len(SD_INDEX_MAGIC)) == SD_INDEX_MAGIC
+    except OSError:
+        return False
+
 
-    :param packet: Packet from the traceroute data (d3_json)
-    :param sd_item: netbeam_cache resource corresponding to the packet's IP.
-    :return: None - the dictionary is altered in place.
+def reload_interface_map(file_path=None, index_path=None):
     """
-    packet['resource'] = sd_item['resource']
-    packet['speed'] = sd_item['speed']
-    res = sd_traffic(sd_item['resource'])
-    if res is not None:
-        packet['traffic_info'] = res
+    Replaces the in-memory interface index if the compiled index file has changed since it was loaded. If the interface
+    file is newer than the compiled index (i.e. it was just rebuilt), the index is compiled from it first.
+    :param file_path: Path to the interface file. If None, uses the path from the config file.
+    :param index_path: Path to the compiled index. If None, uses the path from the config file.
+    :return: True if the index was reloaded, False otherwise.
+    """
+    global _sd_index, _sd_index_mtime
+    if file_path is None:
+        file_path = config.variables['sd_interface_file']
+    if index_path is None:
+        index_path = config.variables['sd_interface_index_file']
+    try:
+        mtime = osstat(file_path).st_mtime
+    except FileNotFoundError:
+        mtime = None
+    try:
+        index_mtime = osstat(index_path).st_mtime
+    except FileNotFoundError:
+        index_mtime = None
 
+    # Indexes compiled in an older format are compiled again too.
+    if mtime is not None and (index_mtime is None or index_mtime < mtime or not _index_current(index_path)):
+        try:
+            with open(file_path, 'r') as f:
+                compile_interface_index(json.load(f), index_path)
+        except json.decoder.JSONDecodeError as e:
+            print(f'Unable to load the Stardust interface file: {e!r}')
+        else:
+            index_mtime = osstat(index_path).st_mtime
 
-def add_sd_info_threaded(d3_json, source_path=None):
-    threads = []
-    sd_cache = load_stardust_file(source_path)
+    if index_mtime is None or index_mtime == _sd_index_mtime:
+        return False
+    try:
+        index = load_interface_index(index_path)
+    except (OSError, ValueError) as e:
+        print(f'Unable to load the Stardust interface index: {e!r}')
+        return False
+    _sd_index = index
+    _sd_index_mtime = index_mtime
+    return True
 
-    for tr in d3_json['traceroutes']:
-        for packet in tr['packets']:
-            if sd_cache.get(packet.get('ip')):
-                # Each thread runs add_netbeam_info_tw
-                thread = threading.Thread(target=add_sd_info_tw, args=(packet, sd_cache[packet['ip']]))
-                threads.append(thread)
-                thread.start()
 
-        # Wait for all threads to finish before returning; we don't need to worry about race conditions or any kind of
-        # concurrent modification because each thread works on separate data.
-    for thread in threads:
-        thread.join()
+def _rebuild_due(file_path):
+    """
+    Full rebuilds are recorded by touching file_path.full; the interface file itself is also rewritten by incremental
+    updates, so its modification time can't be used for this.
+    :param file_path: Path to the interface file.
+    :return: 'full' if the file is missing or hasn't been fully rebuilt within interface_refresh_interval, 'incremental'
+    if it hasn't been updated within sd_interface_incremental_interval (see the config file), or None.
+    """
+    now = time.time()
+    try:
+        age = now - osstat(file_path).st_mtime
+        full_age = now - osstat(f'{file_path}.full').st_mtime
+    except FileNotFoundError:
+        return 'full'
+    if full_age > config.variables['interface_refresh_interval']:
+        return 'full'
+    if age > config.variables['sd_interface_incremental_interval']:
+        return 'incremental'
+    return None
+
+
+def refresh_interface_map(file_path=None):
+    """
+    Reloads the in-memory interface index if the interface file has changed (i.e. another process rebuilt it), and
+    updates the file if it's due (see _rebuild_due). Between full rebuilds, the file is updated incrementally with the
+    interfaces seen since it was last written, so new interfaces show up without querying every interface again. The
+    file is fully rebuilt if it can't be loaded. Updates are skipped if another process is already updating the file.
+    :param file_path: Path to the interface file. If None, uses the path from the config file.
+    :return: None.
+    """
+    if file_path is None:
+        file_path = config.variables['sd_interface_file']
+    reload_interface_map(file_path)
+    if _sd_index is not None and _rebuild_due(file_path) is None:
+        return
+    # Only one process updates the file; the others reload it on their next check.
+    with d3_conversion_utils.file_lock(file_path) as locked:
+        if not locked:
+            return
+        # Check again; another process may have updated it while we were checking.
+        rebuild = _rebuild_due(file_path)
+        if rebuild is None:
+            reload_interface_map(file_path)
+            if _sd_index is not None:
+                return
+            rebuild = 'full'
+        if create_stardust_file(file_path, incremental=rebuild == 'incremental'):
+            if rebuild == 'full':
+                with open(f'{file_path}.full', 'w'):
+                    pass
+            reload_interface_map(file_path)
 
 
 def load_stardust_file(file_path=None):
@@ -175,83 +533,142 @@ def load_stardust_file(file_path=None):
         """
     if file_path is None:
         file_path = config.variables['sd_interface_file']
-    if not path.exists(file_path):
-        create_stardust_file(file_path)
+    if not path.exists(file_path) and not create_stardust_file(file_path):
+        return {}
 
     if time.time() - osstat(file_path).st_mtime > config.variables['interface_refresh_interval']:
         create_stardust_file(file_path)
 
-    with open(file_path, 'r') as f:
-        try:
+    try:
+        with open(file_path, 'r') as f:
             sd_cache = json.loads(f.read())
-        except json.decoder.JSONDecodeError:
-            create_stardust_file(file_path)
+    except json.decoder.JSONDecodeError:
+        if not create_stardust_file(file_path):
+            return {}
+        with open(file_path, 'r') as f:
             sd_cache = json.loads(f.read())
 
     return sd_cache
 
 
-def create_stardust_file(file_path=None):
+def sd_interfaces(since=None):
+    """
+    Gets the Stardust interfaces with an IPv4 address, one page at a time, using a composite aggregation (so that the
+    number of interfaces isn't capped by the aggregation size).
+    :param since: Seconds since epoch. If given, only interfaces seen since then are returned; otherwise interfaces seen
+    in the last 15 minutes are returned.
+    :return: Generator of (ip, {'resource': <value>, 'speed': <value>}).
+    """
+    start = {'gte': int(since * 1000)} if since is not None else {'gte': 'now-15m/m'}
+    after = None
+    while True:
+        composite = {
+            'size': sd_interface_page_size,
+            'sources': [
+                {'ip': {'terms': {'field': 'meta.ipv4'}}},
+                {'resource': {'terms': {'field': 'meta.id'}}},
+                {'speed': {'terms': {'field': 'meta.speed', 'missing_bucket': True}}}
+            ]
+        }
+        if after is not None:
+            composite['after'] = after
+        r = es.search(index='sd_public_interfaces',
+                      body=
+                      {'size': 0,
+                       '_source': False,
+                       'aggs': {
+                           'interfaces': {
+                               'composite': composite
+                           }
+                       },
+                       'query': {
+                           'bool': {
+                               'filter': [
+                                   {'range': {'start': {**start, 'lte': 'now'}}}
+                               ]
+                               ,
+                               'must': [
+                                   {'exists': {'field': 'meta.ipv4'}}
+                               ]
+                           }
+                       }})
+        interfaces = r['aggregations']['interfaces']
+        for bucket in interfaces['buckets']:
+            iface = bucket['key']
+            speed = iface['speed']
+            # The speed we get corresponds to if-mib::ifHighSpeed, which returns the speed in units
+            # of 1000000 bps so we need to multiply by this to get the correct value. This can be double checked by
+            # comparing the values after processing to those found on my.es.net/network/interfaces
+            if speed is not None:
+                speed = speed * 1000000
+            # Addresses reported with their prefix length (a.b.c.d/len) give the size of the link the interface is on.
+            ip, _, prefix = iface['ip'].partition('/')
+            item = {'resource': iface['resource'], 'speed': speed}
+            if prefix.isdigit():
+                item['prefix'] = int(prefix)
+            yield ip, item
+        after = interfaces.get('after_key')
+        if after is None or len(interfaces['buckets']) < sd_interface_page_size:
+            break
+
+
+def create_stardust_file(file_path=None, incremental=False):
     """
-    Convert the result from ${netbeam}/api/network/esnet/prod/interfaces to a json file specified by filePath.
+    Writes the Stardust interfaces (see sd_interfaces) to the json file specified by file_path, as a dictionary of
+    ip => {resource: <value>, speed: <value>}.
 
     This is used to find IP's from the traceroute that are monitored by Netbeam, which can then be polled for more
     information.
 
-    :param file_path: Path to the file. By default this is interfaces.json.
-    :return: None
+    The interfaces are streamed to a temporary file, which then replaces the existing file; if the query fails, the
+    existing file is left as is.
+
+    :param file_path: Path to the file. By default this is the path from the config file.
+    :param incremental: If True and the file exists, only interfaces seen since the file was last written are queried,
+    and they're merged into the existing file (see refresh_interface_map).
+    :return: True if the file was written, False otherwise.
     """
     if file_path is None:
         file_path = config.variables['sd_interface_file']
 
-    with open(file_path, 'wt') as f:
-        res = {}
+    existing = {}
+    since = None
+    if incremental and path.exists(file_path):
+        since = osstat(file_path).st_mtime
         try:
-            r = es.search(index='sd_public_interfaces',
-                          body=
-                          {'size': 0,
-                           '_source': False,
-                           'aggs': {
-                               'interfaces': {
-                                   'multi_terms': {
-                                       'size': 25000,
-                                       'terms': [
-                                           {'field': 'meta.ipv4'},
-                                           {'field': 'meta.id'},
-                                           {'field': 'meta.speed'}
-                                       ]
-                                   }
-                               }
-                           },
-                           'query': {
-                               'bool': {
-                                   'filter': [
-                                       {'range': {'start': {'gte': 'now-15m/m', 'lte': 'now'}}}
-                                   ]
-                                   ,
-                                   'must': [
-                                       {'exists': {'field': 'meta.ipv4'}}
-                                   ]
-                               }
-                           }})
-            interfaces = r['aggregations']['interfaces']['buckets']
-
-            for bucket in interfaces:
-                iface = bucket['key']
-                res[iface[0]] = {
-                    'resource': iface[1],
-                    'speed': iface[2]
-                }
-            # The speed we get corresponds to if-mib::ifHighSpeed, which returns the speed in units
-            # of 1000000 bps so we need to multiply by this to get the correct value. This can be double checked by
-            # comparing the values after processing to those found on my.es.net/network/interfaces
-            for key in res.keys():
-                if res.get(key)['speed'] is not None:
-                    res.get(key)['speed'] = res.get(key)['speed'] * 1000000
-
-            f.write(json.dumps(res))
-        except elasticsearch.exceptions.ConnectionTimeout:
-            print(f'Request for interfaces timed out')
-            return None
+            with open(file_path, 'r') as f:
+                existing = json.load(f)
+        except json.decoder.JSONDecodeError:
+            since = None
 
-    chmod(file_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP)
+    fd, tmp_path = tempfile.mkstemp(dir=path.dirname(path.abspath(file_path)), prefix=path.basename(file_path) + '.',
+                                    suffix='.tmp')
+    try:
+        with open(fd, 'wt') as f:
+            f.write('{')
+            first = True
+            for ip, item in sd_interfaces(since):
+                if ip in existing:
+                    # Written below, with the rest of the existing interfaces.
+                    existing[ip] = item
+                    continue
+                f.write(('' if first else ',') + f'{json.dumps(ip)}:{json.dumps(item)}')
+                first = False
+            for ip, item in existing.items():
+                f.write(('' if first else ',') + f'{json.dumps(ip)}:{json.dumps(item)}')
+                first = False
+            f.write('}')
+        chmod(tmp_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP)
+        replace(tmp_path, file_path)
+        return True
+    except (elasticsearch.exceptions.ConnectionTimeout, elasticsearch.exceptions.ConnectionError) as e:
+        print(f'Request for interfaces failed: {e!r}')
+        remove(tmp_path)
+        return False
+    except BaseException:
+        remove(tmp_path)
+        raise
+
+
+# Load the interface index whenever we load this file; anything missing or out of date is handled by d3_refresher.
+reload_interface_map()
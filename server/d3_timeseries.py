@@ -0,0 +1,188 @@
+"""
+Stale-while-revalidate cache for the traffic time series (TSDS and Stardust). A series is keyed by (source, resource) -
+i.e. (tsds, IP) or (stardust, interface) - and covers the last timeseries_window seconds.
+Series are refreshed at most once per timeseries_step seconds (the aggregation bucket size). A request for a series that
+is older than that gets the cached series immediately, while a single background refresh (on the shared worker pool)
+fetches only the buckets newer than the ones already cached and merges them in. Series older than the whole window are
+fetched again before returning.
+"""
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+from server import config, d3_singleflight, d3_workers
+
+# Used to protect the series and counters below.
+_lock = threading.Lock()
+# (source, resource) => {'points': ..., 'meta': ..., 'bucket': ..., 'updated': ..., 'refreshing': ...}, least recently
+# used first. Points and meta are replaced rather than modified, so they can be handed to callers without copying.
+_series = OrderedDict()
+# source => {'fresh': ..., 'stale': ..., 'misses': ..., 'refreshes': ...}
+_stats = dict()
+
+
+def _source_stats(source):
+    """
+    Must be called with _lock held.
+    """
+    if source not in _stats:
+        _stats[source] = {'fresh': 0, 'stale': 0, 'misses': 0, 'refreshes': 0}
+    return _stats[source]
+
+
+def _trim(points, ts_scale):
+    """
+    :return: Copy of points without the points older than the window.
+    """
+    oldest = (time.time() - config.variables['timeseries_window']) * ts_scale
+    return {key: point for key, point in points.items() if point['ts'] >= oldest}
+
+
+def _store(source, fetched, ts_scale, merge):
+    """
+    Adds fetched series to the cache, evicting the least recently used series if the cache is over its size cap.
+    :param fetched: Dictionary of resource => (points, meta).
+    :param merge: If True, the fetched points are added to the cached points instead of replacing them.
+    """
+    now = time.time()
+    bucket = int(now // config.variables['timeseries_step'])
+    with _lock:
+        for resource, (points, meta) in fetched.items():
+            entry = _series.get((source, resource))
+            if merge and entry is not None:
+                points = {**entry['points'], **points}
+            _series[(source, resource)] = {'points': _trim(points, ts_scale), 'meta': meta, 'bucket': bucket,
+                                           'updated': now, 'refreshing': False}
+            _series.move_to_end((source, resource))
+        while len(_series) > config.variables['timeseries_cache_size']:
+            _series.popitem(last=False)
+
+
+def _refresh(source, resources, fetch, since, ts_scale):
+    """
+    Fetches the newest buckets for the series and merges them into the cache. Runs on the shared worker pool.
+    Series the fetch returns nothing for are marked as refreshed for the current bucket as well, so they aren't
+    refreshed again on every request until the next bucket. If the fetch fails, they're retried in the next bucket.
+    """
+    fetched = None
+    try:
+        fetched = fetch(resources, since)
+        _store(source, fetched, ts_scale, merge=True)
+    finally:
+        now = time.time()
+        bucket = int(now // config.variables['timeseries_step'])
+        with _lock:
+            for resource in resources:
+                entry = _series.get((source, resource))
+                if entry is None:
+                    continue
+                entry['refreshing'] = False
+                if fetched is None or resource not in fetched:
+                    entry['bucket'] = bucket
+                    if fetched is not None:
+                        entry['updated'] = now
+
+
+def _refresh_done(source, future):
+    """
+    Done callback for background refreshes; nothing waits on them, so failures are reported here.
+    """
+    if not future.cancelled() and future.exception() is not None:
+        print(f'Time series refresh for {source} failed: {future.exception()!r}')
+
+
+def get_many(source, resources, fetch, ts_scale=1, overlap=0):
+    """
+    Gets multiple series from the cache, fetching the ones that aren't cached and scheduling a background refresh of the
+    ones that are out of date.
+    :param source: Source name, i.e. tsds or stardust. Also used as the worker pool provider for the refreshes.
+    :param resources: Iterable of resources (strings).
+    :param fetch: Function that accepts a list of resources and a start time (seconds since epoch, or None for the whole
+    window) and returns a dictionary of resource => (points, meta). Points are a dictionary of key => point, where each
+    point has a ts; meta is anything else that should be cached with the series (i.e. the speed). Resources missing from
+    the dictionary aren't cached.
+    :param ts_scale: Number of point ts units per second, i.e. 1000 for millisecond timestamps.
+    :param overlap: Number of seconds before the newest cached point to start refreshes from, for sources that update
+    recent buckets after first reporting them.
+    :return: Dictionary of resource => (points, meta) for every resource with data.
+    """
+    now = time.time()
+    bucket = int(now // config.variables['timeseries_step'])
+    results = {}
+    missing = []
+    stale = []
+    since = now
+    with _lock:
+        stats = _source_stats(source)
+        for resource in resources:
+            entry = _series.get((source, resource))
+            if entry is None or now - entry['updated'] > config.variables['timeseries_window']:
+                missing.append(resource)
+                stats['misses'] += 1
+                continue
+            _series.move_to_end((source, resource))
+            results[resource] = (entry['points'], entry['meta'])
+            if entry['bucket'] == bucket:
+                stats['fresh'] += 1
+                continue
+            stats['stale'] += 1
+            if not entry['refreshing']:
+                entry['refreshing'] = True
+                stale.append(resource)
+                newest = max((point['ts'] for point in entry['points'].values()), default=None)
+                since = min(since, newest / ts_scale - overlap if newest is not None else entry['updated'])
+        if stale:
+            stats['refreshes'] += 1
+
+    # The refresh isn't waited on, so this is safe to call from the worker pool.
+    if stale:
+        future = d3_workers.submit(source, _refresh, source, stale, fetch, since, ts_scale)
+        future.add_done_callback(partial(_refresh_done, source))
+
+    if missing:
+        # If the same series is already being fetched (i.e. by another request), wait for that fetch instead.
+        fetched = d3_singleflight.do_many(f'{source}_series', missing, lambda keys: fetch(keys, None))
+        _store(source, fetched, ts_scale, merge=False)
+        with _lock:
+            for resource in fetched:
+                entry = _series.get((source, resource))
+                if entry is not None:
+                    results[resource] = (entry['points'], entry['meta'])
+    return results
+
+
+def get(source, resource, fetch, ts_scale=1, overlap=0):
+    """
+    Single resource version of get_many.
+    :param fetch: Function that accepts a resource and a start time (seconds since epoch, or None for the whole window)
+    and returns the points for the resource, or None if there aren't any.
+    :return: Points for the resource, or None if there aren't any.
+    """
+    def fetch_many(resources, since):
+        fetched = {}
+        for r in resources:
+            points = fetch(r, since)
+            if points is not None:
+                fetched[r] = (points, None)
+        return fetched
+
+    result = get_many(source, [resource], fetch_many, ts_scale, overlap).get(resource)
+    return result[0] if result is not None else None
+
+
+def put_many(source, fetched, ts_scale=1):
+    """
+    Adds series fetched elsewhere (i.e. as part of another query) to the cache, replacing the cached series.
+    :param fetched: Dictionary of resource => (points, meta).
+    """
+    _store(source, fetched, ts_scale, merge=False)
+
+
+def stats():
+    """
+    :return: Dictionary with the number of series cached and, for each source, the number of fresh hits, stale hits,
+    misses, and background refreshes.
+    """
+    with _lock:
+        return {'series': len(_series), 'sources': {source: dict(counts) for source, counts in _stats.items()}}
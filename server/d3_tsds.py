@@ -3,22 +3,52 @@ Author: Andrew Golightly
 Module for getting information from IU/GRNOCs TSDS.
 TSDS Browser can be found @ https://tsds.wash2.net.internet2.edu/community/?method=browse&measurement_type=interface
 """
+import array
+import bisect
+import math
 import sqlite3
 import threading
-from datetime import datetime
+import time
 
-import requests
+from server import config, d3_conversion_utils, d3_geo_ip, d3_http, d3_singleflight, d3_timeseries, d3_workers
 
-from server import config
+# Connection to the TSDS database, shared by every request; see tsds_connection.
+_con = None
+# sqlite3 connections can't be used by multiple threads at once, so all access to _con goes through this lock.
+_con_lock = threading.Lock()
 
+# In-memory index of every IP in the database, so that the per request path doesn't touch the disk for known IPs. IPv4
+# addresses are kept in parallel packed arrays sorted by IP (9 bytes per IP); see tsds_index_load.
+_index_ips = array.array('I')
+_index_enabled = array.array('B')
+_index_modified = array.array('I')
+# IPs added since the arrays were built (IPv4 as integers, anything else as strings) => (tsds_enabled, last_modified).
+# IPv4 entries are merged into the arrays once there are _index_merge_size of them.
+_index_pending = dict()
+_index_merge_size = 4096
+# Longest prefix match index of the links TSDS interfaces are on (interface_link_prefix in the config file), for hops
+# that report the far side of a point to point link. Link network => interface IP as an integer.
+_index_links = d3_conversion_utils.PrefixIndex()
+# Used to protect the index.
+_index_lock = threading.Lock()
+# PRAGMA data_version of the shared connection when the index was loaded; changes when another process writes to the
+# database (see tsds_index_sync).
+_index_data_version = None
 
-def tsds_query_template(ip,
-                        base_url='https://snapp-portal.grnoc.iu.edu/tsds-cross-domain/query.cgi/services/query.cgi?method=query;'):
+
+def tsds_query_template(ips,
+                        base_url='https://snapp-portal.grnoc.iu.edu/tsds-cross-domain/query.cgi/services/query.cgi?method=query;',
+                        start='now - 15m'):
     """
-    :param ip: IP address we want to get more info for.
+    :param ips: IP address, or list of IP addresses, we want to get more info for. Results are grouped by IP address, so
+    a single query can cover every hop in a traceroute.
     :param base_url: TSDS URL. By default it queries tsds-cross-domain, which should check all available TSDS instances.
+    :param start: Start of the time range to get traffic for.
     :return: Properly formatted URL.
     """
+    if isinstance(ips, str):
+        ips = [ips]
+    where = ' or '.join(f'interface_address.value = "{ip}"' for ip in ips)
     # TODO: Verify that max_bandwidth is what they use on their end for the link speed.
     query = f'{base_url}query=get ' \
             f'aggregate(values.input, 60, average) as traffic_in, ' \
@@ -28,9 +58,9 @@ def tsds_query_template(ip,
             f'aggregate(values.inerror, 60, average) as errors_in, ' \
             f'aggregate(values.outerror, 60, average) as errors_out, ' \
             f'node, intf, description, interface_address.value, max_bandwidth as speed, ' \
-            f'between(now - 15m, now) ' \
-            f'from interface where interface_address.value = "{ip}"'
-    # f'by node, intf, interface_address.value ' \
+            f'between({start}, now) ' \
+            f'by interface_address.value ' \
+            f'from interface where {where}'
 
     return query
 
@@ -42,122 +72,436 @@ def tsds_query_template(ip,
 def add_tsds_info_threaded(tr_data):
     """
     Adds TSDS information to traceroute data, if applicable.
+    IPs that need to be checked against TSDS are queried in batches (tsds_batch_size in the config file) rather than one
+    query per hop. Hops that aren't TSDS interfaces get the information for the TSDS interface on the same link, if
+    there is one (see tsds_link_lookup). Hops that are Stardust interfaces (i.e. have a resource; see
+    d3_stardust.add_sd_interfaces) get their traffic from Stardust, so they're skipped.
     :param tr_data: Dictionary containing the traceroute data. 
-    :param db_path: Path to database. If None, then it uses the config file db path.
     :return: None. Modifies tr_data directly.
     """
-    db_path = config.variables['tsds_db_file']
-
-    # Open connection to db.
-    con = sqlite3.connect(db_path)
-
-    # Create list of threads
-    threads = []
-    for tr in tr_data['traceroutes']:
-        for packet in tr['packets']:
-            # Skip over packets that do not have an IP address.
-            if packet.get('ip'):
-                # Check to see if IP address is already in database.
-                db_result = con.execute('select * from resources where ip=:ip', packet).fetchone()
-                if db_result:
-                    tsds_enabled = db_result[1]
-                    last_time = datetime.strptime(db_result[2], '%Y-%m-%d %H:%M:%S')
-                    # Check to see if the database entry needs to be refreshed.
-                    # If it does, we run tsds_db_tw with existing and modify_db set to true.
-                    if datetime.utcnow().timestamp() - last_time.timestamp() > \
-                            config.variables['tsds_refresh_interval']:
-                        thread = threading.Thread(target=tsds_db_tw, args=(packet, True, True, db_path))
-                        thread.start()
-                        threads.append(thread)
-                    # Refresh isn't needed
-                    else:
-                        # We don't need to modify the db in this case, so we run tsds_db_tw with existing true and
-                        # modify_db false.
-                        if tsds_enabled:
-                            thread = threading.Thread(target=tsds_db_tw, args=(packet, True, False, db_path))
-                            thread.start()
-                            threads.append(thread)
-                # Does not exist in db
-                else:
-                    # Add IP to database by running tsds_db_tw with existing set to false and modify_db set to true
-                    thread = threading.Thread(target=tsds_db_tw, args=(packet, False, True, db_path))
-                    thread.start()
-                    threads.append(thread)
-
-    con.close()
-
-    for thread in threads:
-        thread.join()
+    packets = [packet for tr in tr_data['traceroutes'] for packet in tr['packets']
+               if packet.get('ip') and not packet.get('resource')]
+    ips = {packet['ip'] for packet in packets}
+
+    # Known IPs come from the in-memory index. IPs missing from it are checked against the database with a single query,
+    # in case another process has added them since the index was loaded.
+    entries = tsds_index_get(ips)
+    db_entries = tsds_db_select(ips - entries.keys())
+    tsds_index_add(db_entries)
+    entries.update(db_entries)
+
+    # ip => {'existing': ..., 'modify_db': ..., 'packets': [...], 'link_packets': [...]} for every IP that needs to be
+    # queried.
+    to_query = {}
+    # Packets with IPs known not to be part of TSDS.
+    not_enabled = []
+    for packet in packets:
+        if packet['ip'] in to_query:
+            to_query[packet['ip']]['packets'].append(packet)
+            continue
+        entry = entries.get(packet['ip'])
+        # Entries past the refresh interval are re-verified in the background (see refresh_stale_rows), so the IP is
+        # only queried if it's part of TSDS.
+        if entry:
+            if entry['tsds_enabled']:
+                to_query[packet['ip']] = {'existing': True, 'modify_db': False, 'packets': [packet],
+                                          'link_packets': []}
+            else:
+                not_enabled.append(packet)
+        # Does not exist in db, so the IP is queried and added to the database.
+        else:
+            to_query[packet['ip']] = {'existing': False, 'modify_db': True, 'packets': [packet], 'link_packets': []}
+
+    # Packets on the same link as a TSDS interface get that interface's information.
+    for packet in not_enabled:
+        link_ip = tsds_link_lookup(packet['ip'])
+        if link_ip is not None:
+            to_query.setdefault(link_ip, {'existing': True, 'modify_db': False, 'packets': [], 'link_packets': []})
+            to_query[link_ip]['link_packets'].append(packet)
+
+    # Lookups are run on the shared worker pool (see d3_workers).
+    ips = list(to_query)
+    batch_size = config.variables['tsds_batch_size']
+    futures = [d3_workers.submit('tsds', tsds_batch_tw, ips[i:i + batch_size], to_query)
+               for i in range(0, len(ips), batch_size)]
+    finished = d3_workers.wait_all(futures)
+
+    # Write every insert and update from this request in a single transaction.
+    inserts = []
+    updates = []
+    for future in finished:
+        inserts.extend(future.result()[0])
+        updates.extend(future.result()[1])
+    tsds_db_write(inserts, updates)
+
+
+def refresh_stale_rows():
+    """
+    Re-verifies database entries that are past the refresh interval in the config file against TSDS, in batches, oldest
+    first (up to tsds_refresh_limit entries per run). Run by d3_refresher, so requests never wait on a refresh.
+    :return: Number of entries refreshed.
+    """
+    with _con_lock:
+        rows = tsds_connection().execute(
+            "SELECT ip FROM resources WHERE last_modified < datetime('now', :age) ORDER BY last_modified LIMIT :limit",
+            {'age': f'-{config.variables["tsds_refresh_interval"]} seconds',
+             'limit': config.variables['tsds_refresh_limit']}).fetchall()
+    ips = [row[0] for row in rows]
+
+    updates = []
+    batch_size = config.variables['tsds_batch_size']
+    for i in range(0, len(ips), batch_size):
+        try:
+            results = d3_singleflight.do_many('tsds', ips[i:i + batch_size], tsds_query_batch)
+        except Exception as e:
+            print(f'TSDS refresh failed: {e!r}')
+            continue
+        updates.extend({'tsds_enabled': len(result) > 0, 'ip': ip} for ip, result in results.items())
+    tsds_db_write([], updates)
+    return len(updates)
+
+
+def tsds_connection():
+    """
+    Opens the connection to the TSDS database on first use. The connection is shared by every request, and uses WAL mode
+    so that other processes reading the database aren't blocked by writes. Must be called with _con_lock held.
+    :return: sqlite3 connection.
+    """
+    global _con
+    if _con is None:
+        _con = sqlite3.connect(config.variables['tsds_db_file'], timeout=10, check_same_thread=False)
+        _con.execute('PRAGMA journal_mode=WAL')
+        _con.execute('PRAGMA synchronous=NORMAL')
+    return _con
 
 
 def tsds_db_setup():
     """
     Create the database table with the appropriate schema.
-    :param db_path: Path to the database file. If None, uses the path from the config file.
     :return: None.
     """
-    db_path = config.variables['tsds_db_file']
-    con = sqlite3.connect(db_path)
-    cur = con.cursor()
-    res = cur.execute("SELECT name FROM sqlite_master WHERE TYPE='table' AND NAME='resources'").fetchone()
-    # create table if it doesn't exist
-    if not res:
-        cur.execute(
-            'CREATE TABLE resources (ip text primary key not null, tsds_enabled integer, last_modified datetime default '
-            'current_timestamp)')
-    con.commit()
-    con.close()
-
-
-def tsds_db_tw(packet, existing, modify_db, db_path):
-    """
-    Always checks the IP address to see if it's part of the TSDS. If it is, this parses the TSDS data and adds it to the
-    packet.
-    :param packet: Dictionary - Packet from the traceroute.
-    :param existing: Boolean - true if this ip exists in the db.
-    :param modify_db: Boolean - true if the operation needs to modify db (i.e. existing == false OR last modified past
-    threshold)
-    :param db_path: Path to database. If it is None (i.e. default) it gets set to the config file db path.
-    :return: None - modifies packet directly.
-    """
-    ip = packet.get('ip')
-    r = requests.get(tsds_query_template(ip), timeout=5).json()
-    tsds_enabled = len(r['results']) > 0
-
-    # If IP is part of TSDS, parse info and add to the packet.
-    if tsds_enabled:
-        traffic_info = {}
-        results = r['results'][0]
-        metrics = ['traffic_in', 'traffic_out', 'unicast_packets_in', 'unicast_packets_out', 'errors_in', 'errors_out']
-        for metric in metrics:
-            if metric in results:
-                for entry in results[metric]:
-                    ts_str = str(entry[0])
-                    if ts_str not in traffic_info:
-                        traffic_info[ts_str] = {}
-                        traffic_info[ts_str]['ts'] = entry[0]
-                    traffic_info[ts_str][metric] = entry[1]
-        if 'speed' in results and results['speed'] is not None:
-            packet['max_bandwidth'] = results['speed']
-
-        packet['traffic_info'] = traffic_info
-
-    # We want to modify if the IP is not part of the DB already or if the last_modified is over the threshold defined
-    # in the config file.
-    if modify_db:
-        con = sqlite3.connect(db_path)
-
-        # Use different query for update vs insert.
-        if existing:
+    with _con_lock:
+        con = tsds_connection()
+        res = con.execute("SELECT name FROM sqlite_master WHERE TYPE='table' AND NAME='resources'").fetchone()
+        # create table if it doesn't exist
+        if not res:
             con.execute(
-                'UPDATE resources SET tsds_enabled=:tsds_enabled, last_modified=CURRENT_TIMESTAMP WHERE ip=:ip',
-                {'tsds_enabled': tsds_enabled, 'ip': ip})
-        else:
-            con.execute('INSERT INTO resources (ip, tsds_enabled) VALUES(:ip, :tsds_enabled)',
-                        {'tsds_enabled': tsds_enabled, 'ip': ip})
+                'CREATE TABLE resources (ip text primary key not null, tsds_enabled integer, last_modified datetime '
+                'default current_timestamp)')
         con.commit()
+
+
+def tsds_db_select(ips):
+    """
+    Looks up multiple IP addresses in the database.
+    :param ips: Iterable of IP addresses.
+    :return: Dictionary of IP => {'tsds_enabled': ..., 'last_modified': seconds since epoch} for every IP in the
+    database.
+    """
+    ips = list(ips)
+    entries = {}
+    with _con_lock:
+        con = tsds_connection()
+        # SQLite limits the number of parameters per query, so large lookups are split.
+        for i in range(0, len(ips), 500):
+            chunk = ips[i:i + 500]
+            rows = con.execute(f"SELECT ip, tsds_enabled, CAST(strftime('%s', last_modified) AS INTEGER) "
+                               f"FROM resources WHERE ip IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            for ip, tsds_enabled, last_modified in rows:
+                entries[ip] = {'tsds_enabled': bool(tsds_enabled), 'last_modified': last_modified or 0}
+    return entries
+
+
+def tsds_db_write(inserts, updates):
+    """
+    Adds new IP addresses to the database and refreshes existing ones, all in a single transaction.
+    :param inserts: List of {'ip': ..., 'tsds_enabled': ...} for IPs not in the database yet.
+    :param updates: List of {'ip': ..., 'tsds_enabled': ...} for IPs already in the database.
+    :return: None.
+    """
+    if not inserts and not updates:
+        return
+    with _con_lock:
+        con = tsds_connection()
+        with con:
+            con.executemany('UPDATE resources SET tsds_enabled=:tsds_enabled, last_modified=CURRENT_TIMESTAMP '
+                            'WHERE ip=:ip', updates)
+            # Another process may have added the IP since it was looked up.
+            con.executemany('INSERT OR REPLACE INTO resources (ip, tsds_enabled) VALUES(:ip, :tsds_enabled)', inserts)
+    now = int(time.time())
+    tsds_index_add({row['ip']: {'tsds_enabled': row['tsds_enabled'], 'last_modified': now}
+                    for row in inserts + updates})
+
+
+def _index_key(ip):
+    """
+    :return: Integer representation of an IPv4 address, or the address itself for anything else.
+    """
+    if ip.count('.') == 3:
+        try:
+            return d3_conversion_utils.ip_to_int(ip)
+        except OSError:
+            pass
+    return ip
+
+
+def tsds_index_load(db_path=None):
+    """
+    Builds the in-memory index from the database. The new index is built separately and then published in place of the
+    current one, so requests keep using the current index while it's built.
+    :param db_path: Path to the database file. If None, uses the shared connection to the config file db path.
+    :return: Number of IPs in the index.
+    """
+    global _index_ips, _index_enabled, _index_modified, _index_pending, _index_links, _index_data_version
+    query = "SELECT ip, tsds_enabled, CAST(strftime('%s', last_modified) AS INTEGER) FROM resources"
+    if db_path is None:
+        with _con_lock:
+            con = tsds_connection()
+            # Read before the rows, so a write that lands in between is picked up (again) by the next tsds_index_sync
+            # rather than missed.
+            _index_data_version = con.execute('PRAGMA data_version').fetchone()[0]
+            rows = con.execute(query).fetchall()
+    else:
+        con = sqlite3.connect(db_path)
+        rows = con.execute(query).fetchall()
         con.close()
 
+    ipv4 = []
+    pending = {}
+    for ip, tsds_enabled, last_modified in rows:
+        key = _index_key(ip)
+        if isinstance(key, int):
+            ipv4.append((key, bool(tsds_enabled), last_modified or 0))
+        else:
+            pending[key] = (bool(tsds_enabled), last_modified or 0)
+    del rows
+    ipv4.sort()
+    ips = array.array('I', (r[0] for r in ipv4))
+    enabled = array.array('B', (r[1] for r in ipv4))
+    modified = array.array('I', (r[2] for r in ipv4))
+
+    links = d3_conversion_utils.PrefixIndex()
+    for ip_int, tsds_enabled, _ in ipv4:
+        if tsds_enabled:
+            links.add(ip_int, config.variables['interface_link_prefix'], ip_int)
+
+    with _index_lock:
+        _index_ips, _index_enabled, _index_modified, _index_pending, _index_links = \
+            ips, enabled, modified, pending, links
+    return len(ips) + len(pending)
+
+
+def tsds_index_sync():
+    """
+    Reloads the in-memory index if another process has written to the database since it was loaded, i.e. new IPs, or
+    entries re-verified by refresh_stale_rows in another process. Run by d3_refresher.
+    :return: True if the index was reloaded.
+    """
+    with _con_lock:
+        version = tsds_connection().execute('PRAGMA data_version').fetchone()[0]
+    if version == _index_data_version:
+        return False
+    tsds_index_load()
+    return True
+
+
+def tsds_index_get(ips):
+    """
+    Looks up multiple IP addresses in the in-memory index.
+    :param ips: Iterable of IP addresses.
+    :return: Dictionary of IP => {'tsds_enabled': ..., 'last_modified': seconds since epoch} for every IP in the
+    database.
+    """
+    entries = {}
+    with _index_lock:
+        for ip in ips:
+            key = _index_key(ip)
+            if key in _index_pending:
+                tsds_enabled, last_modified = _index_pending[key]
+                entries[ip] = {'tsds_enabled': tsds_enabled, 'last_modified': last_modified}
+            elif isinstance(key, int):
+                i = bisect.bisect_left(_index_ips, key)
+                if i < len(_index_ips) and _index_ips[i] == key:
+                    entries[ip] = {'tsds_enabled': bool(_index_enabled[i]), 'last_modified': _index_modified[i]}
+    return entries
+
+
+def tsds_index_add(entries):
+    """
+    Adds IP addresses to the in-memory index, or updates them if they're already in it.
+    :param entries: Dictionary of IP => {'tsds_enabled': ..., 'last_modified': seconds since epoch}.
+    :return: None.
+    """
+    with _index_lock:
+        for ip, entry in entries.items():
+            key = _index_key(ip)
+            if isinstance(key, int) and entry['tsds_enabled']:
+                _index_links.add(key, config.variables['interface_link_prefix'], key)
+            if isinstance(key, int):
+                i = bisect.bisect_left(_index_ips, key)
+                if i < len(_index_ips) and _index_ips[i] == key:
+                    _index_enabled[i] = entry['tsds_enabled']
+                    _index_modified[i] = entry['last_modified']
+                    continue
+            _index_pending[key] = (bool(entry['tsds_enabled']), entry['last_modified'])
+        if sum(isinstance(key, int) for key in _index_pending) >= _index_merge_size:
+            _index_merge()
+
+
+def tsds_link_lookup(ip):
+    """
+    Finds the TSDS interface on the other end of the point to point link the IP address is on; traceroute often reports
+    the far side of the link rather than the monitored interface. Private (RFC 1918) addresses are reused across
+    networks, so they never match a link.
+    :param ip: IP address.
+    :return: IP address of the TSDS interface, or None if there isn't one.
+    """
+    key = _index_key(ip)
+    if not isinstance(key, int) or d3_geo_ip.private_ip.match(ip):
+        return None
+    link = _index_links.lookup(key)
+    return d3_conversion_utils.int_to_ip(link) if link is not None and link != key else None
+
+
+def _index_merge():
+    """
+    Must be called with _index_lock held. Merges the pending IPv4 entries into the packed arrays.
+    """
+    global _index_ips, _index_enabled, _index_modified
+    new = sorted((key, value) for key, value in _index_pending.items() if isinstance(key, int))
+    ips, enabled, modified = array.array('I'), array.array('B'), array.array('I')
+    prev = 0
+    for key, (tsds_enabled, last_modified) in new:
+        i = bisect.bisect_left(_index_ips, key)
+        # Copy the run of existing entries before the new one.
+        ips.extend(_index_ips[prev:i])
+        enabled.extend(_index_enabled[prev:i])
+        modified.extend(_index_modified[prev:i])
+        ips.append(key)
+        enabled.append(tsds_enabled)
+        modified.append(last_modified)
+        prev = i
+        del _index_pending[key]
+    ips.extend(_index_ips[prev:])
+    enabled.extend(_index_enabled[prev:])
+    modified.extend(_index_modified[prev:])
+    _index_ips, _index_enabled, _index_modified = ips, enabled, modified
+
+
+def tsds_query_batch(ips, start='now - 15m'):
+    """
+    Queries TSDS for multiple IPs at once.
+    :param ips: List of IP addresses to query.
+    :param start: Start of the time range to get traffic for.
+    :return: Dictionary of IP => TSDS result for that IP. IPs that aren't part of TSDS map to an empty dictionary.
+    """
+    r = d3_http.get(tsds_query_template(ips, start=start), timeout=5).json()
+    results = {ip: {} for ip in ips}
+    for result in r.get('results') or []:
+        addresses = result.get('interface_address.value')
+        if not isinstance(addresses, list):
+            addresses = [addresses]
+        for address in addresses:
+            if address in results and not results[address]:
+                results[address] = result
+    return results
+
+
+def parse_tsds_result(result):
+    """
+    Parses a TSDS result.
+    :param result: TSDS result for a single IP.
+    :return: Tuple of (traffic info, other packet fields - i.e. max_bandwidth).
+    """
+    traffic_info = {}
+    metrics = ['traffic_in', 'traffic_out', 'unicast_packets_in', 'unicast_packets_out', 'errors_in', 'errors_out']
+    for metric in metrics:
+        if metric in result:
+            for entry in result[metric]:
+                ts_str = str(entry[0])
+                if ts_str not in traffic_info:
+                    traffic_info[ts_str] = {}
+                    traffic_info[ts_str]['ts'] = entry[0]
+                traffic_info[ts_str][metric] = entry[1]
+    fields = {}
+    if 'speed' in result and result['speed'] is not None:
+        fields['max_bandwidth'] = result['speed']
+
+    return traffic_info, fields
+
+
+def tsds_traffic(ips, since=None):
+    """
+    Gets the traffic time series for multiple IPs; used as the fetch function for d3_timeseries.
+    :param ips: List of IP addresses.
+    :param since: Seconds since epoch to start from. If None, gets the last 15 minutes.
+    :return: Dictionary of IP => (traffic info, other packet fields) for every IP that's part of TSDS.
+    """
+    start = f'now - {max(1, math.ceil((time.time() - since) / 60))}m' if since is not None else 'now - 15m'
+    return {ip: parse_tsds_result(result) for ip, result in tsds_query_batch(ips, start).items() if result}
+
+
+def tsds_batch_tw(ips, to_query):
+    """
+    Checks a batch of IP addresses to see if they're part of TSDS. For the ones that are, this adds the TSDS data to the
+    packets with that IP. IPs already known to be part of TSDS get their data from the time series cache (see
+    d3_timeseries). IPs that turn out not to be part of TSDS get the information for the TSDS interface on the same
+    link, if there is one (see tsds_link_lookup).
+    :param ips: List of IP addresses to check.
+    :param to_query: Dictionary of IP => {'existing': Boolean - true if this ip exists in the db, 'modify_db': Boolean -
+    true if the operation needs to modify db (i.e. existing == false OR last modified past threshold), 'packets': list
+    of packets with this IP, 'link_packets': list of packets on the same link as this IP}.
+    :return: Tuple of (inserts, updates) - the database changes for the batch, to be passed to tsds_db_write.
+    """
+    check = [ip for ip in ips if to_query[ip]['modify_db']]
+    known = [ip for ip in ips if not to_query[ip]['modify_db']]
+
+    inserts = []
+    updates = []
+    series = {}
+    # Link IP => packets of first-seen IPs on the same link that turn out not to be part of TSDS.
+    new_link_packets = {}
+    if check:
+        # IPs already being queried (i.e. by another request) are waited on instead of being queried again.
+        results = d3_singleflight.do_many('tsds', check, tsds_query_batch)
+        for ip in check:
+            if ip not in results:
+                continue
+            tsds_enabled = len(results[ip]) > 0
+            if tsds_enabled:
+                series[ip] = parse_tsds_result(results[ip])
+            else:
+                link_ip = tsds_link_lookup(ip)
+                if link_ip is not None:
+                    new_link_packets.setdefault(link_ip, []).extend(to_query[ip]['packets'])
+
+            # We want to modify if the IP is not part of the DB already or if the last_modified is over the threshold
+            # defined in the config file.
+            (updates if to_query[ip]['existing'] else inserts).append({'tsds_enabled': tsds_enabled, 'ip': ip})
+        d3_timeseries.put_many('tsds', series)
+
+    # Link IPs are known to be part of TSDS (they're in the index), so their data comes from the time series cache too.
+    # They may not be in this batch, in which case only the link packets are updated here.
+    link_only = new_link_packets.keys() - series.keys() - set(known)
+    known.extend(link_only)
+    if known:
+        # The newest bucket may still be filling up, so refreshes start one bucket before the newest cached one.
+        series.update(d3_timeseries.get_many('tsds', known, tsds_traffic, overlap=config.variables['timeseries_step']))
+
+    # If IP is part of TSDS, add the info to the packets.
+    for ip, (traffic_info, fields) in series.items():
+        entry = {'packets': [], 'link_packets': []} if ip in link_only else to_query[ip]
+        for packet in entry['packets']:
+            packet.update(fields)
+            packet['traffic_info'] = traffic_info
+        for packet in entry['link_packets'] + new_link_packets.get(ip, []):
+            packet.update(fields)
+            packet['traffic_info'] = traffic_info
+            packet['tsds_interface_ip'] = ip
+
+    return inserts, updates
+
 
 # Call setup whenever we load this file
 tsds_db_setup()
+tsds_index_load()
@@ -0,0 +1,136 @@
+"""
+Process-wide worker pool shared by the enrichment modules (TSDS, Stardust, geoIP, RDAP). Rather than spawning a thread
+per packet, work is submitted here under a provider name. The pool has a fixed number of threads, and each provider is
+limited to a configurable number of concurrently running tasks so that a single slow provider can't take over the pool.
+Tasks over a provider's limit wait in a per-provider queue until one of that provider's running tasks finishes.
+"""
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from server import config
+
+_executor = ThreadPoolExecutor(max_workers=config.variables['worker_pool_size'], thread_name_prefix='enrichment')
+
+# Used to protect the queues and counters below.
+_lock = threading.Lock()
+# provider => deque of tasks over the provider's concurrency limit.
+_queued = dict()
+# provider => number of tasks handed to the executor but not yet picked up by a thread.
+_waiting = dict()
+# provider => number of tasks currently running.
+_running = dict()
+# provider => number of tasks finished.
+_completed = dict()
+
+
+def provider_limit(provider):
+    """
+    :param provider: Provider name.
+    :return: Maximum number of tasks the provider is allowed to have in the executor at once.
+    """
+    limits = config.variables['provider_concurrency']
+    return limits.get(provider, limits['default'])
+
+
+def submit(provider, fn, *args, **kwargs):
+    """
+    Submits work to the pool. Work submitted to the pool should not wait on other work submitted to the pool, as this
+    can deadlock once all of the threads are waiting.
+    :param provider: Name of the provider the work is for; used for the concurrency limits and stats.
+    :param fn: Function to run.
+    :return: concurrent.futures.Future for the result of fn(*args, **kwargs).
+    """
+    future = Future()
+    with _lock:
+        _queued.setdefault(provider, deque()).append((future, fn, args, kwargs))
+    _dispatch(provider)
+    return future
+
+
+def _dispatch(provider):
+    """
+    Hands queued tasks for the provider to the executor while the provider is under its concurrency limit.
+    :param provider: Provider name.
+    """
+    tasks = []
+    with _lock:
+        queue = _queued[provider]
+        limit = provider_limit(provider)
+        while queue and _waiting.get(provider, 0) + _running.get(provider, 0) < limit:
+            tasks.append(queue.popleft())
+            _waiting[provider] = _waiting.get(provider, 0) + 1
+    for task in tasks:
+        _executor.submit(_run, provider, *task)
+
+
+def _run(provider, future, fn, args, kwargs):
+    """
+    Runs a single task on one of the executor's threads and passes the result (or exception) on to the task's future.
+    """
+    with _lock:
+        _waiting[provider] -= 1
+        _running[provider] = _running.get(provider, 0) + 1
+    try:
+        if future.set_running_or_notify_cancel():
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+    finally:
+        with _lock:
+            _running[provider] -= 1
+            _completed[provider] = _completed.get(provider, 0) + 1
+        _dispatch(provider)
+
+
+def wait_all(futures, timeout=None):
+    """
+    Waits for all of the futures to finish, or for the timeout to pass. Exceptions are printed rather than raised, which
+    matches the behavior of the thread per packet implementations this replaces. Tasks that haven't finished by the
+    timeout are cancelled if they haven't started yet, and left out of the results either way, so a stuck provider
+    only fails the hops it was working on rather than the whole request.
+    :param futures: Iterable of futures returned by submit.
+    :param timeout: Number of seconds to wait. If None, uses worker_wait_timeout from the config file.
+    :return: List of the futures that finished without an exception, in the order given.
+    """
+    futures = list(futures)
+    done, not_done = wait(futures, timeout=config.variables['worker_wait_timeout'] if timeout is None else timeout)
+    for future in not_done:
+        future.cancel()
+    if not_done:
+        print(f'{len(not_done)} enrichment tasks timed out')
+    finished = []
+    for future in futures:
+        if future not in done:
+            continue
+        if future.exception() is not None:
+            print(f'Enrichment task failed: {future.exception()!r}')
+        else:
+            finished.append(future)
+    return finished
+
+
+def stats():
+    """
+    :return: Dictionary with the size of the pool and, for each provider, the number of tasks queued (over the
+    concurrency limit), waiting for a thread, running, and completed.
+    """
+    with _lock:
+        providers = set(_queued) | set(_waiting) | set(_running) | set(_completed)
+        return {
+            'pool_size': config.variables['worker_pool_size'],
+            'queue_depth': sum(len(q) for q in _queued.values()) + sum(_waiting.values()),
+            'active_workers': sum(_running.values()),
+            'providers': {
+                provider: {
+                    'limit': provider_limit(provider),
+                    'queued': len(_queued.get(provider, ())),
+                    'waiting': _waiting.get(provider, 0),
+                    'running': _running.get(provider, 0),
+                    'completed': _completed.get(provider, 0)
+                } for provider in providers
+            }
+        }